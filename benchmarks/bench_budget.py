@@ -0,0 +1,76 @@
+"""
+Time budgeted test selection on synthetic coverage of changed regions.
+Compares lazy greedy evaluation with rescoring every test after each
+choice, which is only run on the smaller sizes.
+
+    python benchmarks/bench_budget.py [n_tests] [n_regions] [seconds]
+"""
+import random
+import sys
+import time
+
+from smother.selection import budget
+
+
+def synthetic_covers(tests, regions, rng):
+    # a few hot regions are covered by many tests
+    hot = list(range(min(20, regions)))
+    covers = {}
+    for idx in range(tests):
+        units = set(rng.sample(range(regions), rng.randint(0, 10)))
+        if rng.random() < 0.3:
+            units.add(rng.choice(hot))
+        covers['test_%06i' % idx] = units
+    durations = {test: rng.lognormvariate(0, 1) for test in covers}
+    return covers, durations
+
+
+def rescoring_budget(covers, durations, seconds):
+    """
+    Greedy selection without lazy evaluation.
+    """
+    chosen, covered, spent = [], set(), 0.0
+    candidates = set(test for test, units in covers.items() if units)
+    while True:
+        best = None
+        for test in candidates:
+            if spent + durations[test] > seconds:
+                continue
+            score = len(covers[test] - covered) / durations[test]
+            if score and (best is None or score > best[0]):
+                best = (score, test)
+        if best is None:
+            return chosen, covered
+        test = best[1]
+        candidates.remove(test)
+        chosen.append(test)
+        covered |= covers[test]
+        spent += durations[test]
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    regions = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 600
+    rng = random.Random(0)
+
+    print("%8s %10s %10s %10s" % ('tests', 'chosen', 'lazy', 'rescoring'))
+    for size in sorted({tests // 10, tests}):
+        covers, durations = synthetic_covers(size, regions, rng)
+
+        start = time.time()
+        chosen, covered, _ = budget(covers, durations, seconds)
+        lazy_time = time.time() - start
+
+        rescoring = '-'
+        if size <= 10000:
+            start = time.time()
+            rescoring_budget(covers, durations, seconds)
+            rescoring = '%.2fs' % (time.time() - start)
+
+        print("%8i %10i %9.2fs %10s" % (
+            size, len(chosen), lazy_time, rescoring))
+
+
+if __name__ == "__main__":
+    main()
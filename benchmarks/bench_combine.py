@@ -0,0 +1,75 @@
+"""
+Compare streaming, in-memory and multi-process `smother combine`
+on synthetic shards, with per-phase timings.
+
+    python benchmarks/bench_combine.py [n_shards] [tests_per_shard] [jobs]
+"""
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import mkdtemp
+
+from synthetic import synthetic_data
+
+from smother import storage
+
+COMBINE = """
+import sys, time
+from click.testing import CliRunner
+from smother.cli import cli
+start = time.time()
+result = CliRunner().invoke(cli, ['combine', '--timings'] + sys.argv[1:])
+assert result.exit_code == 0, result.output
+elapsed = time.time() - start
+sys.stderr.write(result.output)
+with open('/proc/self/status') as status:
+    hwm = [line.split()[1] for line in status if line.startswith('VmHWM')]
+print(elapsed, hwm[0])
+"""
+
+
+def write_shards(base, shards, tests):
+    paths = []
+    for shard in range(shards):
+        data = synthetic_data(tests=tests, seed=shard)
+        data = {
+            '%s[%i]' % (test, shard): cover
+            for test, cover in data.items()
+        }
+        path = os.path.join(base, 'shard_%i.smother' % shard)
+        with open(path, 'wb') as outfile:
+            storage.dump(data, outfile)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    argv = argv if argv is not None else sys.argv[1:]
+    shards = int(argv[0]) if len(argv) > 0 else 20
+    tests = int(argv[1]) if len(argv) > 1 else 200
+    jobs = int(argv[2]) if len(argv) > 2 else 4
+    base = mkdtemp()
+
+    try:
+        paths = write_shards(base, shards, tests)
+        outputs = []
+        for flag in ['--stream', '--no-stream', '--jobs=%i' % jobs]:
+            dst = os.path.join(base, 'combined' + flag)
+            out = subprocess.check_output(
+                [sys.executable, '-c', COMBINE, flag] + paths + [dst])
+            elapsed, hwm = out.split()
+            print("%-12s %6.2fs  maxrss %6.1f MB" % (
+                flag, float(elapsed), int(hwm) / 1024.))
+            with open(dst, 'rb') as infile:
+                outputs.append(infile.read())
+        # the multi-process report has one segment per process
+        print("identical output: %s" % (outputs[0] == outputs[1]))
+        print("identical coverage: %s" % (
+            storage.loads(outputs[0]) == storage.loads(outputs[2])))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
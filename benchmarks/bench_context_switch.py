@@ -0,0 +1,88 @@
+"""
+Measure the per-test overhead of switching smother contexts, comparing
+the old approach (reset the collector before every test) with draining
+the collector in place.
+
+Each simulated test calls one function in each of a handful of measured
+modules, so the timings are dominated by start/stop/save overhead.
+
+    python benchmarks/bench_context_switch.py [n_tests] [n_modules]
+"""
+import os
+import sys
+import time
+from importlib import import_module
+from tempfile import mkdtemp
+
+import coverage
+
+from smother.control import Smother
+
+MODULE = """
+def func(x):
+    y = x + 1
+    return y
+"""
+
+
+class ResetSmother(Smother):
+    """
+    The capture path before contexts were drained in place.
+    """
+
+    def start(self):
+        self.coverage.collector.reset()
+        self.coverage.start()
+
+    def save_context(self, label):
+        self.data[label] = {
+            key: sorted(map(int, val.keys()))
+            for key, val in self.coverage.collector.data.items()
+        }
+
+
+def make_modules(count):
+    base = mkdtemp()
+    for idx in range(count):
+        with open(os.path.join(base, 'bench_mod_%04i.py' % idx), 'w') as fh:
+            fh.write(MODULE)
+    sys.path.insert(0, base)
+    return base, [
+        import_module('bench_mod_%04i' % idx) for idx in range(count)]
+
+
+def run(cls, base, modules, tests, per_test=5):
+    cov = coverage.coverage(source=[base])
+    smother = cls(cov)
+    cov.start()
+    cov.stop()
+    smother.save_context("")
+
+    start = time.time()
+    for test in range(tests):
+        smother.start()
+        for offset in range(per_test):
+            modules[(test + offset) % len(modules)].func(test)
+        cov.stop()
+        smother.save_context('test_%i' % test)
+    elapsed = time.time() - start
+    return elapsed, smother.data
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    base, modules = make_modules(count)
+
+    reset_time, reset_data = run(ResetSmother, base, modules, tests)
+    drain_time, drain_data = run(Smother, base, modules, tests)
+    # both paths must record the same lines
+    assert reset_data == drain_data
+
+    print("%-8s %12s" % ('capture', 'us per test'))
+    print("%-8s %12.1f" % ('reset', 1e6 * reset_time / tests))
+    print("%-8s %12.1f" % ('drain', 1e6 * drain_time / tests))
+
+
+if __name__ == "__main__":
+    main()
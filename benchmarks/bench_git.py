@@ -0,0 +1,110 @@
+"""
+Compare reading old file contents with one `git show` per file
+against a single `git cat-file --batch` process, on a scratch
+repository with many files. Then time building the old side's
+PythonFiles with an empty context cache directory, and again with
+the cache filled by the first run (as in a later CI build). Finally,
+time finding the intervals changed in every file with one process and
+with several.
+
+    python benchmarks/bench_git.py [n_files] [jobs]
+"""
+import os
+import subprocess
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from smother.git import CatFile
+from smother.git import GitDiffReporter
+from smother.git import git_show
+from smother.python import CACHE
+
+MODULE = ''.join(
+    'def func_%i(x):\n    return x + %i\n\n\n' % (i, i) for i in range(40))
+
+
+def make_repo(count):
+    base = mkdtemp()
+    for idx in range(count):
+        with open(os.path.join(base, 'module_%04i.py' % idx), 'w') as fh:
+            fh.write(MODULE)
+
+    def git(*args):
+        subprocess.check_call(('git',) + args, cwd=base,
+                              stdout=subprocess.DEVNULL)
+
+    git('init', '-q')
+    git('add', '.')
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+        'commit', '-q', '-m', 'bench')
+    return base
+
+
+def old_files(paths):
+    CACHE.clear()  # as if in a new process
+    reporter = GitDiffReporter('HEAD', diff='skip')
+    start = time.time()
+    for path in paths:
+        reporter.old_file(path)
+    reporter.close()
+    return time.time() - start
+
+
+def changed_intervals(jobs):
+    CACHE.clear()
+    reporter = GitDiffReporter('HEAD')
+    start = time.time()
+    intervals = list(reporter.changed_intervals(jobs=jobs))
+    reporter.close()
+    return time.time() - start, intervals
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    base = make_repo(count)
+    paths = ['module_%04i.py' % idx for idx in range(count)]
+    cwd = os.getcwd()
+    os.chdir(base)
+    try:
+        start = time.time()
+        shown = [git_show('HEAD', path) for path in paths]
+        show_time = time.time() - start
+
+        start = time.time()
+        cat_file = CatFile()
+        batched = [cat_file.show('HEAD', path) for path in paths]
+        cat_file.close()
+        batch_time = time.time() - start
+
+        CACHE.directory = os.path.join(base, '.smother_cache')
+        cold_time = old_files(paths)
+        warm_time = old_files(paths)
+        assert CACHE.disk_hits == count
+
+        CACHE.directory = None
+        for path in paths:
+            with open(path, 'w') as fh:
+                fh.write(MODULE.replace('x + 1', 'x - 1'))
+        serial_time, serial = changed_intervals(1)
+        parallel_time, parallel = changed_intervals(jobs)
+        assert serial == parallel
+    finally:
+        CACHE.directory = None
+        os.chdir(cwd)
+        rmtree(base)
+
+    assert shown == batched
+    print("%i files" % count)
+    print("%-22s %.3fs" % ('git show', show_time))
+    print("%-22s %.3fs" % ('git cat-file --batch', batch_time))
+    print("%-22s %.3fs" % ('old files, cold cache', cold_time))
+    print("%-22s %.3fs" % ('old files, warm cache', warm_time))
+    print("%-22s %.3fs" % ('changed intervals', serial_time))
+    print("%-22s %.3fs" % ('changed, %i jobs' % jobs, parallel_time))
+
+
+if __name__ == "__main__":
+    main()
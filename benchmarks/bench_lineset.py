@@ -0,0 +1,96 @@
+"""
+Compare sorted line lists with LineSet bitmaps on a synthetic suite:
+memory held per test, combining two reports, and intersecting every
+test with a region.
+
+    python benchmarks/bench_lineset.py [n_tests]
+"""
+import sys
+import time
+import tracemalloc
+
+from synthetic import synthetic_data
+
+from smother.lineset import LineSet
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, size
+
+
+def combine_lists(a, b):
+    # the list-based merge from Smother.__ior__
+    for test, cover in b.items():
+        for path, lines in cover.items():
+            old = a.setdefault(test, {}).setdefault(path, [])
+            a[test][path] = sorted(set(old + lines))
+
+
+def combine_linesets(a, b):
+    for test, cover in b.items():
+        for path, lines in cover.items():
+            target = a.setdefault(test, {})
+            target[path] = lines | target.get(path, ())
+
+
+def intersect_lists(data, path, start, stop):
+    return [
+        test for test, cover in data.items()
+        if any(start <= line < stop for line in cover.get(path, []))
+    ]
+
+
+def intersect_linesets(data, path, start, stop):
+    region = LineSet.from_range(start, stop)
+    return [
+        test for test, cover in data.items()
+        if region.intersects(cover.get(path, ()))
+    ]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    raw = synthetic_data(tests=tests)
+    other = synthetic_data(tests=tests, seed=1)
+
+    lists, list_size = measure_memory(lambda: {
+        test: {path: list(lines) for path, lines in cover.items()}
+        for test, cover in raw.items()
+    })
+    linesets, lineset_size = measure_memory(lambda: {
+        test: {path: LineSet(lines) for path, lines in cover.items()}
+        for test, cover in raw.items()
+    })
+    other_linesets = {
+        test: {path: LineSet(lines) for path, lines in cover.items()}
+        for test, cover in other.items()
+    }
+
+    print("memory per test: lists %.1f KB, LineSets %.1f KB" % (
+        list_size / 1024. / tests, lineset_size / 1024. / tests))
+
+    _, list_time = timed(combine_lists, lists, other)
+    _, lineset_time = timed(combine_linesets, linesets, other_linesets)
+    print("combine:   lists %.3fs, LineSets %.3fs" % (
+        list_time, lineset_time))
+
+    args = ('/src/pkg/module_0007.py', 100, 200)
+    a, list_time = timed(intersect_lists, lists, *args)
+    b, lineset_time = timed(intersect_linesets, linesets, *args)
+    assert a == b
+    print("intersect: lists %.3fs, LineSets %.3fs" % (
+        list_time, lineset_time))
+
+
+if __name__ == "__main__":
+    main()
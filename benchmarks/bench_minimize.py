@@ -0,0 +1,36 @@
+"""
+Time suite minimization (greedy set cover) on a synthetic report.
+
+    python benchmarks/bench_minimize.py [n_tests] [n_files]
+"""
+import sys
+import time
+
+from synthetic import synthetic_data
+
+from smother.lineset import LineSet
+from smother.selection import minimize
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    covers = {
+        test: {path: LineSet(lines) for path, lines in cover.items()}
+        for test, cover in synthetic_data(tests=tests, files=files).items()
+    }
+    pairs = sum(
+        len(lines) for cover in covers.values() for lines in cover.values())
+
+    start = time.time()
+    chosen, covered = minimize(covers)
+    elapsed = time.time() - start
+
+    print("%i tests, %i (test, file, line) triples, %i distinct lines" % (
+        tests, pairs, sum(map(len, covered.values()))))
+    print("chose %i tests in %.2fs" % (len(chosen), elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Time query_context for a broad change: many line and context regions
+spread over many files of a synthetic report. Compares the masked
+query with the old approach of testing every covered line of every
+test against each region in turn.
+
+    python benchmarks/bench_query.py [n_tests] [n_files_changed]
+"""
+import random
+import sys
+import time
+
+from synthetic import synthetic_data
+
+from smother.control import Smother
+from smother.interval import ContextInterval
+from smother.interval import LineInterval
+from smother.lineset import LineSet
+from smother.python import PythonFile
+
+# 10-line methods in 100-line classes, for 800-line synthetic modules
+SOURCE = ''.join(
+    'class C%d(object):\n' % cls + ''.join(
+        '    def m%d(self):\n' % method + '        pass\n' * 9
+        for method in range(9)
+    ) + '\n' * 18
+    for cls in range(8)
+)
+
+
+def python_file(filename):
+    return PythonFile(filename, source=SOURCE, prefix='mod')
+
+
+def regions_for(paths, hunks, rng):
+    regions = []
+    for path in paths:
+        pf = python_file(path)
+        for _ in range(hunks):
+            start = rng.randint(1, 780)
+            regions.append(LineInterval(path, start, start + 5))
+            regions.append(ContextInterval(path, pf.context(start)))
+    return regions
+
+
+def query_by_line(smother, regions):
+    """
+    The query before regions were combined into masks.
+    """
+    result = set()
+    for region in regions:
+        pf = python_file(region.filename)
+        for test, hits in smother.data.items():
+            if test in result:
+                continue
+            lines = hits.get(region.filename, [])
+            if isinstance(region, LineInterval):
+                if any(region.start <= line < region.stop
+                       for line in lines):
+                    result.add(test)
+            elif any(pf.context(line) == region.context for line in lines):
+                result.add(test)
+    return result
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    changed = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    smother = Smother()
+    smother.data = {
+        test: {path: LineSet(lines) for path, lines in cover.items()}
+        for test, cover in synthetic_data(tests=tests).items()
+    }
+    rng = random.Random(0)
+    paths = ['/src/pkg/module_%04i.py' % i for i in range(changed)]
+    regions = regions_for(paths, 5, rng)
+
+    start = time.time()
+    old = query_by_line(smother, regions)
+    old_time = time.time() - start
+
+    start = time.time()
+    new = smother.query_context(regions, file_factory=python_file)
+    new_time = time.time() - start
+
+    assert old == set(new.contexts)
+    print("%i regions in %i files, %i matching tests" % (
+        len(regions), changed, len(old)))
+    print("per line: %.3fs" % old_time)
+    print("masked:   %.3fs" % new_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Compare the size, load time and peak memory of JSON, binary and SQLite
+reports, and the cost of a single lookup against an eager or lazily
+read report.
+
+    python benchmarks/bench_storage.py [n_tests]
+"""
+import os
+import subprocess
+import sys
+import time
+from tempfile import mkdtemp
+
+from synthetic import synthetic_data
+
+from smother import coverage_db
+from smother import storage
+
+LOAD = """
+import sys, time
+from smother.control import Smother
+from smother.interval import LineInterval
+
+
+class FakeFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+
+start = time.time()
+smother = Smother.load(sys.argv[1], lazy=sys.argv[2] == 'lazy')
+if sys.argv[3] == 'lookup':
+    region = LineInterval('/src/pkg/module_0007.py', 100, 110)
+    smother.query_context([region], file_factory=FakeFile)
+elapsed = time.time() - start
+# ru_maxrss survives exec on Linux, so read this process's own peak
+with open('/proc/self/status') as status:
+    hwm = [line.split()[1] for line in status if line.startswith('VmHWM')]
+print(elapsed, hwm[0])
+"""
+
+
+def measure(path, mode='eager', action='load'):
+    out = subprocess.check_output(
+        [sys.executable, '-c', LOAD, path, mode, action])
+    elapsed, maxrss = out.split()
+    return float(elapsed), int(maxrss) / 1024.
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = synthetic_data(tests=tests)
+    base = mkdtemp()
+
+    print("%-8s %10s %10s %10s %12s" % (
+        'format', 'size (MB)', 'write (s)', 'load (s)', 'maxrss (MB)'))
+    for fmt in storage.FORMATS + (storage.SQLITE,):
+        path = os.path.join(base, 'report.' + fmt)
+        start = time.time()
+        if fmt == storage.SQLITE:
+            coverage_db.write(path, data)
+        else:
+            with open(path, 'wb') as outfile:
+                storage.dump(data, outfile, fmt)
+        write_time = time.time() - start
+
+        load_time, maxrss = measure(path)
+        print("%-8s %10.1f %10.2f %10.2f %12.1f" % (
+            fmt, os.path.getsize(path) / 1e6, write_time,
+            load_time, maxrss))
+
+        for mode in ('eager', 'lazy'):
+            elapsed, maxrss = measure(path, mode, 'lookup')
+            print("    %s lookup: %.3fs, maxrss %.1f MB" % (
+                mode, elapsed, maxrss))
+        os.remove(path)
+    os.rmdir(base)
+
+
+if __name__ == "__main__":
+    main()
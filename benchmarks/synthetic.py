@@ -0,0 +1,29 @@
+"""
+Generate synthetic smother reports for benchmarking.
+"""
+import random
+
+
+def synthetic_data(tests=2000, files=500, files_per_test=40,
+                   file_length=800, seed=0):
+    """
+    Build {test: {file: lines}} coverage resembling a real suite.
+
+    Each test visits a few "functions" (contiguous line ranges) in a
+    random subset of files, plus the module-level lines executed at
+    import time.
+    """
+    rng = random.Random(seed)
+    paths = ['/src/pkg/module_%04i.py' % i for i in range(files)]
+
+    data = {}
+    for test in range(tests):
+        cover = {}
+        for path in rng.sample(paths, files_per_test):
+            lines = set(range(1, 20))
+            for _ in range(rng.randint(1, 5)):
+                start = rng.randint(20, file_length - 30)
+                lines.update(range(start, start + rng.randint(3, 30)))
+            cover[path] = sorted(lines)
+        data['tests/test_%02i.py::test_%05i' % (test % 50, test)] = cover
+    return data
@@ -45,7 +45,7 @@ setup(
         'more_itertools',
         'coverage>=4',
         'portalocker>=0.4',
-        'six',
+        'six>=1.13',
         'unidiff',
     ],
     entry_points={
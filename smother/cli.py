@@ -1,12 +1,26 @@
 import csv as _csv
 import os
+from collections import OrderedDict
+from collections import defaultdict
 
 import click
 import coverage
+import six
+from portalocker import LockException
 
+from smother import storage
+from smother.control import QueryResult
 from smother.control import Smother
+from smother.control import timed
 from smother.git import GitDiffReporter
 from smother.interval import parse_intervals
+from smother.lineset import LineSet
+from smother.python import CACHE
+from smother.python import InvalidPythonFile
+from smother.python import PythonFile
+from smother.selection import budget as _budget
+from smother.selection import minimize as _minimize
+from smother.selection import shard as _shard
 
 
 @click.group()
@@ -22,9 +36,21 @@ from smother.interval import parse_intervals
     default=True,
     help='Coverage config file'
 )
+@click.option(
+    '--cache-dir',
+    envvar='SMOTHER_CACHE_DIR',
+    type=click.Path(file_okay=False),
+    help='Cache the parsed contexts of source files in this directory. '
+         'Also set by the SMOTHER_CACHE_DIR environment variable.'
+)
+@click.option(
+    '--cache-stats',
+    is_flag=True,
+    help='Print context cache hits and misses to stderr.'
+)
 @click.version_option()
 @click.pass_context
-def cli(ctx, report, semantic, rcfile):
+def cli(ctx, report, semantic, rcfile, cache_dir, cache_stats):
     """
     Query or manipulate smother reports
     """
@@ -34,56 +60,176 @@ def cli(ctx, report, semantic, rcfile):
         'rcfile': rcfile,
     }
 
+    CACHE.directory = cache_dir
+    if cache_stats:
+        ctx.call_on_close(_print_cache_stats)
+
+
+def _print_cache_stats():
+    for name, count in CACHE.stats.items():
+        click.echo("%-10s %8i" % (name, count), err=True)
+
+
+def _load_report(opts):
+    """
+    Load the report given by the command line options for reading.
+    Queries map paths with the aliases in the coverage config.
+
+    Reports that other processes have appended to are read as they are,
+    merging their segments on the fly, rather than compacted: that would
+    take the writers' lock and rewrite the file (see `compact`).
+    """
+    return Smother.load(
+        opts['report'], lazy=True,
+        coverage=coverage.Coverage(config_file=opts['rcfile']))
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise click.BadParameter('must be of the form K/N')
+    if not 1 <= index <= count:
+        raise click.BadParameter('K must be between 1 and N')
+    return index, count
+
 
-def _report_from_regions(regions, opts, **kwargs):
-    report_file = opts['report']
-    smother = Smother.load(report_file)
-    result = smother.query_context(regions, **kwargs)
+shard_option = click.option(
+    '--shard',
+    metavar='K/N',
+    callback=_parse_shard,
+    help='Split the selected tests into N groups of similar total '
+         'duration, and only report the K-th group.'
+)
+
+
+def _report_from_regions(regions, opts, shard=None, budget=None, **kwargs):
+    smother = _load_report(opts)
+    if budget is None:
+        result = smother.query_context(regions, **kwargs)
+    else:
+        result = _query_budget(smother, regions, budget, **kwargs)
+    if shard is not None:
+        index, count = shard
+        groups = _shard(result.contexts, smother.durations, count)
+        result.contexts = groups[index - 1]
     result.report()
 
 
+def _query_budget(smother, regions, seconds, **kwargs):
+    """
+    Select the tests covering the most regions within a time budget,
+    and print a summary of the regions they cover to stderr.
+    """
+    covers = defaultdict(set)
+    for idx, tests in enumerate(
+            smother.region_coverage(regions, **kwargs).values()):
+        for test in tests:
+            if test:  # "" is coverage from before the first test
+                covers[test].add(idx)
+
+    chosen, covered, spent = _budget(covers, smother.durations, seconds)
+    total = len(set().union(*covers.values()))
+    click.echo(
+        "covered %i of %i changed regions (%.1f%%) in %.1fs of %.1fs" % (
+            len(covered), total, 100.0 * len(covered) / max(total, 1),
+            spent, seconds),
+        err=True)
+    return QueryResult(chosen)
+
+
 @cli.command()
 @click.argument("path")
+@shard_option
 @click.pass_context
-def lookup(ctx, path):
+def lookup(ctx, path, shard):
     """
     Determine which tests intersect a source interval.
     """
     regions = parse_intervals(path, as_context=ctx.obj['semantic'])
-    _report_from_regions(regions, ctx.obj)
+    _report_from_regions(regions, ctx.obj, shard=shard)
 
 
 @cli.command()
 @click.argument("branch", default="")
+@click.option(
+    '--jobs', '-j',
+    default=1,
+    type=click.IntRange(1),
+    help='Fetch and parse changed files with this many processes.'
+)
+@click.option(
+    '--budget',
+    type=float,
+    metavar='SECONDS',
+    help='Only report the tests which cover the most changed regions '
+         'per second of recorded duration, within a total of SECONDS. '
+         'The coverage achieved is printed to stderr.'
+)
+@shard_option
 @click.pass_context
-def diff(ctx, branch):
+def diff(ctx, branch, jobs, budget, shard):
     """
     Determine which tests intersect a git diff.
     """
     diff = GitDiffReporter(branch)
-    regions = diff.changed_intervals()
-    _report_from_regions(regions, ctx.obj, file_factory=diff.old_file)
+    try:
+        regions = diff.changed_intervals(jobs=jobs)
+        _report_from_regions(regions, ctx.obj, shard=shard, budget=budget,
+                             file_factory=diff.old_file)
+    finally:
+        diff.close()
 
 
 @cli.command()
-@click.argument('src', nargs=-1, type=click.File())
+@click.argument('src', nargs=-1, type=click.Path(exists=True))
 @click.argument('dst', nargs=1, type=click.Path())
+@click.option(
+    '--stream/--no-stream',
+    default=True,
+    help='Merge reports one test at a time instead of loading '
+         'every report into memory. Ignored for JSON output.'
+)
+@click.option(
+    '--jobs', '-j',
+    default=1,
+    type=click.IntRange(1),
+    help='Merge reports with this many processes, each writing the '
+         'tests in one partition. Implies --stream.'
+)
+@click.option(
+    '--timings',
+    is_flag=True,
+    help='Print the time spent in each phase to stderr.'
+)
 @click.pass_context
-def combine(ctx, src, dst):
+def combine(ctx, src, dst, stream, jobs, timings):
     """
     Combine several smother reports.
     """
     c = coverage.Coverage(config_file=ctx.obj['rcfile'])
     result = Smother(c)
+    phases = OrderedDict()
 
-    for infile in src:
-        result |= Smother.load(infile)
+    if ((stream or jobs > 1) and
+            storage.format_for_path(dst) == storage.BINARY):
+        result.combine(src, dst, timings=phases, jobs=jobs)
+    else:
+        with timed(phases, 'load'):
+            for infile in src:
+                result |= Smother.load(infile)
+        with timed(phases, 'write'):
+            result.write(dst, index=True)
 
-    result.write(dst)
+    if timings:
+        for phase, seconds in phases.items():
+            click.echo("%-8s %8.3fs" % (phase, seconds), err=True)
 
 
 @cli.command()
-@click.argument('src', nargs=1, type=click.File())
+@click.argument('src', nargs=1, type=click.Path(exists=True))
 @click.argument('dst', nargs=1, type=click.Path())
 def convert_to_relative_paths(src, dst):
     """
@@ -102,13 +248,79 @@ def csv(ctx, dst):
     Flatten a coverage file into a CSV
     of source_context, testname
     """
-    sm = Smother.load(ctx.obj['report'])
+    sm = _load_report(ctx.obj)
     semantic = ctx.obj['semantic']
     writer = _csv.writer(dst, lineterminator='\n')
     dst.write("source_context, test_context\n")
     writer.writerows(sm.iter_records(semantic=semantic))
 
 
+def _context_cover(cover, files):
+    """
+    Map {file: lines} coverage to the contexts of each file, skipping
+    files which can't be read or parsed.
+    """
+    result = {}
+    for path, lines in six.iteritems(cover):
+        if path not in files:
+            try:
+                files[path] = PythonFile(path)
+            except (IOError, InvalidPythonFile):
+                files[path] = None
+        if files[path] is not None:
+            result[path] = files[path].context_ids(lines)
+    return result
+
+
+@cli.command()
+@click.pass_context
+def minimize(ctx):
+    """
+    Find a small set of tests which cover every line covered by the
+    whole report (or every function and class, with --semantic).
+
+    Coverage recorded before the first test is ignored.
+    """
+    sm = _load_report(ctx.obj)
+    semantic = ctx.obj['semantic']
+
+    covers = {}
+    files = {}
+    for test, cover in six.iteritems(sm.data):
+        if not test:
+            continue
+        if semantic:
+            cover = _context_cover(cover, files)
+        covers[test] = {
+            path: LineSet.coerce(lines)
+            for path, lines in six.iteritems(cover)
+        }
+
+    chosen, covered = _minimize(covers, sm.durations)
+    click.echo("%i of %i tests cover all %i %s" % (
+        len(chosen), len(covers), sum(map(len, covered.values())),
+        'contexts' if semantic else 'lines'), err=True)
+    QueryResult(chosen).report()
+
+
+@cli.command()
+@click.option(
+    '--timeout',
+    default=10,
+    help='Seconds to wait for processes writing to the report.'
+)
+@click.pass_context
+def compact(ctx, timeout):
+    """
+    Merge the appended segments of a report into one.
+    """
+    try:
+        Smother.compact(ctx.obj['report'], timeout=timeout)
+    except LockException:
+        raise click.ClickException(
+            "%s is locked by another process" % ctx.obj['report'])
+
+
 @cli.command()
 @click.pass_context
 def erase(ctx):
@@ -125,6 +337,6 @@ def to_coverage(ctx):
     """
     Produce a .coverage file from a smother file
     """
-    sm = Smother.load(ctx.obj['report'])
+    sm = _load_report(ctx.obj)
     sm.coverage = coverage.coverage()
     sm.write_coverage()
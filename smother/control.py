@@ -1,29 +1,47 @@
-import json
+import multiprocessing
 import os
 import random
+import shutil
 import six
 import socket
+import threading
+import time
+import zlib
 from collections import defaultdict
+from collections import OrderedDict
 from contextlib import contextmanager
+from functools import reduce
+from operator import or_
 from coverage.files import PathAliases
 from coverage.files import relative_filename
 from coverage.files import set_relative_directory
 from portalocker import Lock
+from portalocker import LockException
+from six.moves.queue import Queue
 
+from smother import coverage_db
+from smother import storage
+from smother.lineset import LineSet
 from smother.python import InvalidPythonFile
 from smother.python import PythonFile
 
 
-def create_path_aliases_from_coverage(coverage):
+def create_path_aliases(paths):
+    """
+    Build PathAliases from a coverage config's [paths] section.
+    """
     aliases = PathAliases()
-    if coverage and coverage.config.paths:
-        for paths in coverage.config.paths.values():
-            result = paths[0]
-            for pattern in paths[1:]:
-                aliases.add(pattern, result)
+    for patterns in (paths or {}).values():
+        result = patterns[0]
+        for pattern in patterns[1:]:
+            aliases.add(pattern, result)
     return aliases
 
 
+def create_path_aliases_from_coverage(coverage):
+    return create_path_aliases(coverage and coverage.config.paths)
+
+
 def get_smother_filename(base_name, parallel_mode):
     if parallel_mode:
         suffix = "%s.%s.%06d" % (
@@ -34,6 +52,63 @@ def get_smother_filename(base_name, parallel_mode):
     return base_name
 
 
+@contextmanager
+def timed(timings, phase):
+    """
+    Add the time spent in a block to `timings[phase]`.
+
+    `timings` may be None, in which case nothing is recorded.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + time.time() - start
+
+
+def _merge_sources(sources, fh, map_path, select=None, timings=None):
+    """
+    Stream several reports into a binary report open in `fh`.
+
+    See `storage.merge` for `map_path` and `select`.
+    """
+    with timed(timings, 'load'):
+        loaded = [Smother.load(path, lazy=True) for path in sources]
+        reports = [smother.data for smother in loaded]
+        durations = storage.merge_durations(
+            {}, *[smother.durations for smother in loaded])
+
+    try:
+        with timed(timings, 'merge'):
+            storage.merge(reports, fh, map_path=map_path,
+                          durations=durations, select=select)
+    finally:
+        for report in reports:
+            if isinstance(report, (storage.Report, coverage_db.CoverageDB)):
+                report.close()
+
+
+def _partition(test, jobs):
+    """
+    The partition of a `jobs`-way parallel merge that a test belongs to.
+    """
+    return zlib.crc32(test.encode('utf8')) % jobs
+
+
+def _merge_part(args):
+    """
+    Merge one partition of the tests in a set of reports, in a worker
+    process. The path aliases are rebuilt from the coverage config,
+    since PathAliases cannot always be pickled.
+    """
+    sources, paths, part, jobs, outpath = args
+    aliases = create_path_aliases(paths)
+    with open(outpath, 'w+b') as outfile:
+        _merge_sources(sources, outfile, aliases.map,
+                       select=lambda test: _partition(test, jobs) == part)
+
+
 @contextmanager
 def noclose(file):
     """
@@ -45,6 +120,75 @@ def noclose(file):
         pass
 
 
+def _is_journal(fh):
+    """
+    Whether new segments can be appended to a report open in `fh`.
+    """
+    fh.seek(0)
+    head = fh.read(len(storage.MAGIC))
+    return not head or storage.is_binary(head)
+
+
+class BackgroundWriter(object):
+    """
+    Append test contexts to a report from a background thread.
+
+    Contexts are queued by `put` and appended to the report as new
+    segments (see `Smother.write`). Contexts which arrive while a
+    segment is being written are batched into the next segment.
+    """
+
+    def __init__(self, path, timeout=10, format=None):
+        self.path = path
+        self.timeout = timeout
+        self.format = format
+        self.queue = Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, label, cover, duration=None):
+        self.queue.put((label, cover, duration))
+
+    def close(self):
+        """
+        Write any queued contexts and stop the thread.
+
+        Raises
+        ------
+        Any error encountered while writing.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = Smother()
+            items = [self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get())
+
+            for item in items:
+                if item is None:
+                    done = True
+                else:
+                    label, cover, duration = item
+                    batch.data[label] = cover
+                    if duration is not None:
+                        batch.durations[label] = duration
+
+            if batch.data and self.error is None:
+                try:
+                    batch.write(self.path, append=True,
+                                timeout=self.timeout, format=self.format)
+                except Exception as exc:
+                    self.error = exc
+
+
 class QueryResult(object):
     def __init__(self, contexts):
         self.contexts = contexts
@@ -58,17 +202,101 @@ class Smother(object):
     def __init__(self, coverage=None):
         self.coverage = coverage
         self.data = {}
+        # {test: seconds} wall time of each test context, where known
+        self.durations = {}
         self.aliases = create_path_aliases_from_coverage(self.coverage)
+        self.writer = None
+
+    def tests_for_file(self, path):
+        """
+        Return the tests which executed any line of `path`.
+
+        Lazily loaded reports answer this from their own index, or
+        directory of files (see `storage.Segment.tests_for_file`).
+        Otherwise, `data` is scanned on each call, so that the answer
+        reflects any changes made to it.
+        """
+        lookup = getattr(self.data, 'tests_for_file', None)
+        if lookup is not None:
+            return set(lookup(path))
+
+        return set(
+            test_context for test_context, cover in six.iteritems(self.data)
+            if cover.get(path))
 
     def start(self):
-        self.coverage.collector.reset()
         self.coverage.start()
 
-    def save_context(self, label):
-        self.data[label] = {
-            key: sorted(map(int, val.keys()))
-            for key, val in self.coverage.collector.data.items()
-        }
+    def save_context(self, label, duration=None):
+        """
+        Record the lines traced since the last context under `label`,
+        and optionally the time in seconds that the context took.
+
+        The collector's per-file line dicts are drained in place rather
+        than discarded with `collector.reset()`. Resetting also empties
+        coverage's cache of which files to trace, which every test would
+        then have to rebuild; tracers may also hold references to the
+        per-file dicts, so they are cleared instead of replaced.
+        """
+        cover = {}
+        for key, val in self.coverage.collector.data.items():
+            if val:
+                cover[key] = LineSet(val)
+                val.clear()
+        if self.writer is not None:
+            self.writer.put(label, cover, duration)
+        else:
+            self.data[label] = cover
+            if duration is not None:
+                self.durations[label] = duration
+
+    def stream(self, path, append=False, timeout=10, format=None):
+        """
+        Write each context to `path` as soon as it is saved.
+
+        Contexts are appended to the report by a background thread
+        instead of accumulating in `data`, so memory use does not grow
+        with the number of tests, and the report survives if the
+        process is killed. Call `close_stream` when finished.
+
+        Parameters
+        ----------
+        path : str
+            Report to write to
+        append : bool
+            If False, erase any existing report at `path` first.
+        timeout : int
+            Time in seconds to wait to acquire the report's file lock.
+        format : str (optional)
+            The report format (see `write`)
+
+        Returns
+        -------
+        The path being written to, including any `parallel_mode` suffix.
+        """
+        if self.coverage:
+            path = get_smother_filename(path, self.coverage.config.parallel)
+
+        if not append:
+            Smother().write(path, timeout=timeout, format=format)
+
+        self.writer = BackgroundWriter(path, timeout=timeout, format=format)
+        return path
+
+    def close_stream(self, compact=True):
+        """
+        Finish writing contexts saved since `stream` was called.
+
+        Parameters
+        ----------
+        compact : bool
+            If True, merge the segments appended by the stream, unless
+            another process is writing to the report (see `compact`).
+        """
+        writer, self.writer = self.writer, None
+        writer.close()
+        if compact:
+            Smother.try_compact(writer.path)
 
     def write_coverage(self):
         # coverage won't write data if it hasn't been started.
@@ -84,7 +312,8 @@ class Smother(object):
         self.coverage.collector.data = data
         self.coverage.save()
 
-    def write(self, file_or_path, append=False, timeout=10):
+    def write(self, file_or_path, append=False, timeout=10, format=None,
+              index=False):
         """
         Write Smother results to a file.
 
@@ -98,6 +327,15 @@ class Smother(object):
         timeout : int
             Time in seconds to wait to acquire a file lock, before
             raising an error.
+        format : str (optional)
+            One of 'binary', 'json' or 'sqlite'. By default, paths
+            ending in .json and text-mode files are written as JSON,
+            paths ending in .db or .sqlite as SQLite databases, and
+            everything else uses the binary format.
+        index : bool
+            If True, include an inverted index in a binary report,
+            which speeds up later queries (see `smother.storage`).
+            Segments appended to an existing report are not indexed.
 
         Note
         ----
@@ -105,6 +343,14 @@ class Smother(object):
         and can be safely run in a multithreaded or
         multiprocess test environment.
 
+        Appending to a binary report does not re-read it. Instead,
+        a self-contained segment is added to the end of the file,
+        and readers merge segments when loading. The file lock is
+        only held while the segment is written. See `compact`.
+
+        SQLite reports are written in a single transaction, and do not
+        use a separate file lock. See `smother.coverage_db`.
+
         When using `parallel_mode`, file_or_path is given a unique
         suffix based on the machine name and process id.
         """
@@ -113,16 +359,34 @@ class Smother(object):
                 file_or_path = get_smother_filename(
                     file_or_path, self.coverage.config.parallel)
 
+            format = format or storage.format_for_path(file_or_path)
+            if format == storage.SQLITE:
+                coverage_db.write(file_or_path, self.data,
+                                  append=append, timeout=timeout,
+                                  durations=self.durations)
+                return
+
             outfile = Lock(
-                file_or_path, mode='a+',
+                file_or_path, mode='a+b',
                 timeout=timeout,
                 fail_when_locked=False
             )
         else:
+            format = format or storage.format_for_file(file_or_path)
             outfile = noclose(file_or_path)
 
+        segment = None
+        if append and format == storage.BINARY:
+            # encode before locking, to keep the critical section short
+            segment = storage.dumps(self.data, durations=self.durations)
+
         with outfile as fh:
 
+            if segment is not None and _is_journal(fh):
+                fh.seek(0, os.SEEK_END)
+                fh.write(segment)
+                return
+
             if append:
                 fh.seek(0)
                 try:
@@ -134,20 +398,109 @@ class Smother(object):
 
             fh.seek(0)
             fh.truncate()  # required to overwrite data in a+ mode
-            json.dump(self.data, fh)
+            storage.dump(self.data, fh, format, self.durations, index)
+
+    @classmethod
+    def compact(cls, path, timeout=10):
+        """
+        Merge the segments of an appended-to binary report into one,
+        and index it.
+
+        Readers merge segments on the fly, so this is never required,
+        but it makes subsequent reads of the report faster.
+
+        Parameters
+        ----------
+        path : str
+            The report to compact
+        timeout : int
+            Time in seconds to wait for other writers. If 0, fail at
+            once if another process holds the lock.
+
+        Returns
+        -------
+        True if the report was rewritten.
+        """
+        if not os.path.exists(path) or coverage_db.is_sqlite(path):
+            return False
+
+        with Lock(path, mode='a+b', timeout=timeout,
+                  fail_when_locked=not timeout) as fh:
+            return storage.compact(fh)
+
+    @classmethod
+    def try_compact(cls, path):
+        """
+        Compact a report unless another process is writing to it.
+
+        Returns
+        -------
+        True if the report was rewritten.
+        """
+        try:
+            return cls.compact(path, timeout=0)
+        except LockException:
+            return False
 
     @classmethod
-    def load(cls, file_or_path):
+    def load(cls, file_or_path, lazy=False, coverage=None):
+        """
+        Load a smother report in any supported format.
+
+        Parameters
+        ----------
+        file_or_path : str or file
+            The report to load
+        lazy : bool (optional, default=False)
+            If True and `file_or_path` is a path to a binary report,
+            memory-map the report instead of reading it. The resulting
+            `data` is a read-only mapping that only decodes coverage
+            as it is accessed.
+        coverage : coverage.Coverage (optional)
+            Used to map paths in queries with the config's [paths]
+            aliases, as for `Smother(coverage)`.
+
+        Paths to SQLite reports, including coverage.py data files with
+        dynamic contexts, are also accepted (see `smother.coverage_db`).
+        """
+        if (isinstance(file_or_path, six.string_types) and
+                os.path.isfile(file_or_path) and
+                coverage_db.is_sqlite(file_or_path)):
+            data = db = coverage_db.CoverageDB.open(file_or_path)
+            durations = db.durations()
+            if not lazy:
+                try:
+                    data = {test: cover for test, cover in db.items()}
+                finally:
+                    db.close()
+            result = cls(coverage)
+            result.data = data
+            result.durations = durations
+            return result
+
+        if lazy and isinstance(file_or_path, six.string_types):
+            try:
+                data = storage.Report.open(file_or_path)
+            except ValueError:  # empty or JSON report
+                pass
+            else:
+                result = cls(coverage)
+                result.data = data
+                result.durations = data.durations()
+                return result
+
         if isinstance(file_or_path, six.string_types):
-            infile = open(file_or_path)
+            infile = open(file_or_path, 'rb')
         else:
             infile = noclose(file_or_path)
 
         with infile as fh:
-            data = json.load(fh)
+            contents = fh.read()
+            data = storage.loads(contents)
 
-        result = cls()
+        result = cls(coverage)
         result.data = data
+        result.durations = storage.loads_durations(contents)
         return result
 
     @classmethod
@@ -161,14 +514,83 @@ class Smother(object):
 
         result = cls()
         result.data = dict(data)
+        result.durations = dict(smother_obj.durations)
         return result
 
+    def combine(self, sources, outpath, timings=None, jobs=1):
+        """
+        Merge several reports into a new binary report.
+
+        This produces the same coverage as `|=`-ing each source into an
+        empty Smother and writing it, but reads binary sources lazily
+        and streams the result to disk, so memory use does not grow
+        with the number of sources. JSON sources are loaded in full.
+
+        Parameters
+        ----------
+        sources : sequence of str
+            Paths of the reports to merge
+        outpath : str
+            Path to write the merged report to. Source files are
+            mapped using this Smother's path aliases.
+        timings : dict (optional)
+            If provided, the time spent in each phase is added to the
+            'load' and 'merge' keys, or 'merge' and 'concat' if
+            `jobs` > 1.
+        jobs : int
+            Number of processes to merge with. Tests are partitioned
+            by a hash of their name, each process merges and indexes
+            one partition of every source into a segment, and the
+            segments are concatenated into the report.
+        """
+        if self.coverage:
+            outpath = get_smother_filename(
+                outpath, self.coverage.config.parallel)
+
+        # write to a temporary file, in case outpath is also a source
+        tmppath = "%s.%i.tmp" % (outpath, os.getpid())
+        try:
+            if jobs > 1:
+                self._combine_parts(sources, tmppath, jobs, timings)
+            else:
+                with open(tmppath, 'w+b') as outfile:
+                    _merge_sources(sources, outfile, self.aliases.map,
+                                   timings=timings)
+            os.rename(tmppath, outpath)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def _combine_parts(self, sources, outpath, jobs, timings=None):
+        paths = self.coverage.config.paths if self.coverage else None
+        parts = [
+            (sources, paths, part, jobs, "%s.%i" % (outpath, part))
+            for part in range(jobs)
+        ]
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            with timed(timings, 'merge'):
+                pool.map(_merge_part, parts)
+            with open(outpath, 'wb') as outfile, timed(timings, 'concat'):
+                for part in parts:
+                    with open(part[-1], 'rb') as infile:
+                        shutil.copyfileobj(infile, outfile)
+        finally:
+            pool.close()
+            pool.join()
+            for part in parts:
+                if os.path.exists(part[-1]):
+                    os.remove(part[-1])
+
     def __ior__(self, other):
         for ctx, cover in other.data.items():
             for src, lines in cover.items():
                 src = self.aliases.map(src)
-                old = self.data.setdefault(ctx, {}).setdefault(src, [])
-                self.data[ctx][src] = sorted(set(old + lines))
+                target = self.data.setdefault(ctx, {})
+                target[src] = LineSet.coerce(lines) | target.get(src, ())
+        storage.merge_durations(self.durations, other.durations)
         return self
 
     def query_context(self, regions, file_factory=PythonFile):
@@ -189,30 +611,148 @@ class Smother(object):
         A QueryResult
         """
         result = set()
+        indexed = self._indexed()
 
+        # combine the regions in each file into one mask, so that
+        # each test is compared against each file once
+        by_file = OrderedDict()
         for region in regions:
+            by_file.setdefault(region.filename, []).append(region)
+
+        variants = {
+            filename: self._path_variants(filename) for filename in by_file
+        }
+        if not indexed:
+            coverage_by_path = self._coverage_by_path(
+                set().union(*variants.values()))
+
+        for filename, file_regions in six.iteritems(by_file):
             try:
-                pf = file_factory(region.filename)
+                pf = file_factory(filename)
             except InvalidPythonFile:
                 continue
 
-            # region and/or coverage report may use paths
-            # relative to this directory. Ensure we find a match
-            # if they use different conventions.
-            paths = {
-                os.path.abspath(region.filename),
-                os.path.relpath(region.filename)
-            }
-            for test_context, hits in six.iteritems(self.data):
-                if test_context in result:
+            mask = reduce(or_, (region.mask(pf) for region in file_regions))
+
+            for path in variants[filename]:
+                if indexed:
+                    result.update(
+                        self.data.tests_for_lines(path, mask.__contains__))
                     continue
 
-                for path in paths:
-                    if region.intersects(pf, hits.get(path, [])):
+                for test_context, lines in coverage_by_path.get(path, ()):
+                    if (test_context not in result and
+                            mask.intersects(lines)):
                         result.add(test_context)
 
         return QueryResult(result)
 
+    def region_coverage(self, regions, file_factory=PythonFile):
+        """
+        Find the test contexts which visit each of several code regions.
+
+        Unlike `query_context`, which finds the tests visiting any of
+        the regions, this records which of the regions each test visits.
+
+        Parameters
+        ----------
+        regions: A sequence of Intervals
+
+        file_factory: Callable (optional, default PythonFile)
+            A callable that takes a filename and
+            returns a PythonFile object.
+
+        Returns
+        -------
+        An OrderedDict mapping each distinct region to the set of test
+        contexts which visit it. Regions in files which cannot be
+        parsed map to an empty set.
+        """
+        result = OrderedDict((region, set()) for region in regions)
+        indexed = self._indexed()
+
+        by_file = OrderedDict()
+        for region in result:
+            by_file.setdefault(region.filename, []).append(region)
+
+        variants = {
+            filename: self._path_variants(filename) for filename in by_file
+        }
+        if not indexed:
+            coverage_by_path = self._coverage_by_path(
+                set().union(*variants.values()))
+
+        for filename, file_regions in six.iteritems(by_file):
+            try:
+                pf = file_factory(filename)
+            except InvalidPythonFile:
+                continue
+
+            for region in file_regions:
+                mask = region.mask(pf)
+                tests = result[region]
+                for path in variants[filename]:
+                    if indexed:
+                        tests.update(self.data.tests_for_lines(
+                            path, mask.__contains__))
+                        continue
+
+                    tests.update(
+                        test_context
+                        for test_context, lines in coverage_by_path.get(
+                            path, ())
+                        if mask.intersects(lines))
+
+        return result
+
+    def _path_variants(self, filename):
+        """
+        Return the paths under which a report may record `filename`.
+
+        Regions and/or coverage reports may use paths relative to this
+        directory, and reports may have been combined using coverage's
+        path aliases. Ensure we find a match if they use different
+        conventions.
+        """
+        paths = {os.path.abspath(filename), os.path.relpath(filename)}
+        return paths | set(self.aliases.map(path) for path in paths)
+
+    def _coverage_by_path(self, paths):
+        """
+        Collect the coverage of several files.
+
+        Lazily loaded reports only visit the tests which executed each
+        file (see `tests_for_file`). In-memory data is read in a single
+        pass, every time, so that the result always reflects its current
+        contents.
+
+        Returns
+        -------
+        {path: [(test, lines)]}
+        """
+        result = defaultdict(list)
+        if getattr(self.data, 'tests_for_file', None) is not None:
+            for path in paths:
+                for test_context in self.data.tests_for_file(path):
+                    lines = self.data[test_context].get(path)
+                    if lines:
+                        result[path].append((test_context, lines))
+            return result
+
+        for test_context, cover in six.iteritems(self.data):
+            for path in paths:
+                lines = cover.get(path)
+                if lines:
+                    result[path].append((test_context, lines))
+        return result
+
+    def _indexed(self):
+        """
+        Whether `data` can look up the tests covering a file directly
+        (see `storage.Report.tests_for_lines`).
+        """
+        return getattr(self.data, 'indexed', False)
+
     def _invert(self):
         """
         Invert coverage data from {test_context: {file: line}}
@@ -0,0 +1,320 @@
+"""
+Smother reports stored in SQLite, using coverage.py's own schema.
+
+coverage.py 5 and later can label every measured line with a *dynamic
+context*. When the pytest plugin runs with ``--smother-contexts`` it
+switches coverage's context to the id of each test, and the resulting
+data file is a complete smother report. Smother writes its own SQLite
+reports (see `write`) with the same tables::
+
+    file       (id, path)
+    context    (id, context)
+    line_bits  (file_id, context_id, numbits)
+
+`numbits` is a bitmap of the lines measured in one file during one
+context: bit ``n % 8`` of byte ``n // 8`` is set when line ``n`` ran.
+That is the little-endian bitmap read by `LineSet.from_bytes`.
+
+The wall time of each test is stored in one more table, which
+coverage.py ignores::
+
+    smother_duration  (context_id, duration)
+
+Databases written by smother use SQLite's write-ahead log, so that
+several processes can append to one report concurrently without a
+separate file lock.
+"""
+import os
+import sqlite3
+import time
+
+from six.moves.collections_abc import Mapping
+
+from smother.lineset import LineSet
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# stay below SQLite's default limit of 999 parameters per statement
+CHUNK_SIZE = 500
+
+SCHEMA = """
+create table if not exists meta (
+    key text, value text, unique (key)
+);
+create table if not exists file (
+    id integer primary key, path text, unique (path)
+);
+create table if not exists context (
+    id integer primary key, context text, unique (context)
+);
+create table if not exists line_bits (
+    file_id integer, context_id integer, numbits blob,
+    unique (context_id, file_id)
+);
+create index if not exists line_bits_file on line_bits (file_id);
+create table if not exists smother_duration (
+    context_id integer primary key, duration real
+);
+"""
+
+
+def is_sqlite(path):
+    """
+    Whether the file at `path` is an SQLite database.
+    """
+    with open(path, 'rb') as infile:
+        return infile.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def _set_wal(connection, timeout):
+    """
+    Switch a database to write-ahead logging.
+
+    Changing the journal mode can fail with "database is locked" while
+    another process sets up the same database, without waiting for the
+    busy timeout, so retry for up to `timeout` seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            connection.execute("pragma journal_mode=wal")
+            return
+        except sqlite3.OperationalError as exc:
+            if 'locked' not in str(exc) or time.time() >= deadline:
+                raise
+            time.sleep(0.01)
+
+
+def _numbits_union(a, b):
+    return sqlite3.Binary(
+        (LineSet.from_bytes(a) | LineSet.from_bytes(b)).to_bytes())
+
+
+def _ids(connection, table, column, values):
+    """
+    Insert any missing `values` into `table`, and map them to row ids.
+
+    Only the rows of `values` are read back, so the cost of a write does
+    not grow with the size of the table.
+    """
+    values = list(values)
+    connection.executemany(
+        "insert or ignore into %s (%s) values (?)" % (table, column),
+        [(value,) for value in values])
+
+    result = {}
+    for start in range(0, len(values), CHUNK_SIZE):
+        chunk = values[start:start + CHUNK_SIZE]
+        result.update(
+            (value, idx) for idx, value in connection.execute(
+                "select id, %s from %s where %s in (%s)" % (
+                    column, table, column, ', '.join('?' * len(chunk))),
+                chunk))
+    return result
+
+
+def write(path, data, append=False, timeout=10, durations=None):
+    """
+    Write {test: {file: lines}} coverage to an SQLite report.
+
+    Parameters
+    ----------
+    path : str
+        The database to write to. It is created if it does not exist.
+    data : mapping
+        The coverage to write
+    append : bool
+        If True, merge `data` into the existing report. Otherwise,
+        replace its contents.
+    timeout : int
+        Time in seconds to wait for other writers to finish.
+    durations : dict (optional)
+        {test: seconds} durations to store. When appending, a test
+        keeps its longest duration.
+    """
+    durations = durations or {}
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    try:
+        connection.create_function('numbits_union', 2, _numbits_union)
+        _set_wal(connection, timeout)
+
+        # take the write lock up front, rather than upgrading a read lock,
+        # and create the tables under it (executescript would commit)
+        connection.execute("begin immediate")
+        try:
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    connection.execute(statement)
+            if not append:
+                for table in ('line_bits', 'smother_duration',
+                              'context', 'file'):
+                    connection.execute("delete from %s" % table)
+            connection.execute(
+                "insert or ignore into meta values ('has_arcs', '0')")
+
+            paths = set()
+            for cover in data.values():
+                paths.update(cover)
+            file_ids = _ids(connection, 'file', 'path', sorted(paths))
+            context_ids = _ids(connection, 'context', 'context',
+                               sorted(set(data) | set(durations)))
+
+            # merge into existing rows, then add the rest. This avoids
+            # upserts, which need SQLite 3.24
+            rows = [
+                (file_ids[path], context_ids[test],
+                 sqlite3.Binary(LineSet.coerce(lines).to_bytes()))
+                for test, cover in data.items()
+                for path, lines in cover.items()
+            ]
+            if append:
+                connection.executemany(
+                    "update line_bits "
+                    "set numbits = numbits_union(numbits, ?) "
+                    "where file_id = ? and context_id = ?",
+                    [(numbits, file_id, context_id)
+                     for file_id, context_id, numbits in rows])
+            connection.executemany(
+                "insert or ignore into line_bits values (?, ?, ?)", rows)
+
+            rows = [
+                (context_ids[test], duration)
+                for test, duration in durations.items()
+            ]
+            if append:
+                connection.executemany(
+                    "update smother_duration "
+                    "set duration = max(duration, ?) where context_id = ?",
+                    [(duration, context_id)
+                     for context_id, duration in rows])
+            connection.executemany(
+                "insert or ignore into smother_duration values (?, ?)", rows)
+            connection.execute("commit")
+        except BaseException:
+            connection.execute("rollback")
+            raise
+    finally:
+        connection.close()
+
+
+class CoverageDB(Mapping):
+    """
+    Read-only {test: {file: lines}} view of an SQLite report.
+
+    Tests are coverage's dynamic contexts. Coverage is read with
+    SQL queries as it is accessed, and `tests_for_lines` uses the
+    database's indexes to only read the rows for one file.
+    """
+
+    indexed = True
+
+    def __init__(self, connection):
+        self.connection = connection
+        tables = {
+            row[0] for row in connection.execute(
+                "select name from sqlite_master where type = 'table'")
+        }
+        if not {'file', 'context', 'line_bits'} <= tables:
+            raise ValueError("Not an SQLite smother report")
+
+        arcs = connection.execute(
+            "select value from meta where key = 'has_arcs'").fetchone()
+        if arcs is not None and arcs[0] not in ('0', 0):
+            raise ValueError(
+                "Branch coverage data files are not supported")
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open an SQLite report or coverage.py data file.
+
+        Raises
+        ------
+        ValueError, if `path` is not an SQLite report.
+        """
+        if not os.path.isfile(path) or not is_sqlite(path):
+            raise ValueError("%s is not an SQLite report" % path)
+        return cls(sqlite3.connect(path))
+
+    def close(self):
+        self.connection.close()
+
+    def durations(self):
+        """
+        Return the {test: seconds} durations recorded in the report.
+        """
+        try:
+            rows = self.connection.execute(
+                "select context.context, smother_duration.duration "
+                "from smother_duration "
+                "join context on context.id = smother_duration.context_id"
+            ).fetchall()
+        except sqlite3.OperationalError:  # no smother_duration table
+            return {}
+        return dict(rows)
+
+    def tests_for_file(self, path):
+        """
+        Return the set of tests which executed any line of `path`.
+        """
+        rows = self.connection.execute(
+            "select context.context "
+            "from line_bits "
+            "join file on file.id = line_bits.file_id "
+            "join context on context.id = line_bits.context_id "
+            "where file.path = ?", (path,))
+        return {row[0] for row in rows}
+
+    def tests_for_lines(self, path, predicate):
+        """
+        Find tests that cover part of a file.
+
+        Parameters
+        ----------
+        path : str
+            The source file
+        predicate : callable
+            Called with each covered line number in `path`
+
+        Returns
+        -------
+        The set of tests which cover a line for which `predicate`
+        is True.
+        """
+        rows = self.connection.execute(
+            "select context.context, line_bits.numbits "
+            "from line_bits "
+            "join file on file.id = line_bits.file_id "
+            "join context on context.id = line_bits.context_id "
+            "where file.path = ?", (path,))
+        return {
+            test for test, numbits in rows
+            if any(predicate(line) for line in LineSet.from_bytes(numbits))
+        }
+
+    def __getitem__(self, test):
+        rows = self.connection.execute(
+            "select file.path, line_bits.numbits "
+            "from line_bits "
+            "join file on file.id = line_bits.file_id "
+            "join context on context.id = line_bits.context_id "
+            "where context.context = ?", (test,)).fetchall()
+        if not rows and test not in self:
+            raise KeyError(test)
+        return {
+            path: LineSet.from_bytes(numbits) for path, numbits in rows
+        }
+
+    def __contains__(self, test):
+        return self.connection.execute(
+            "select 1 from context where context = ?",
+            (test,)).fetchone() is not None
+
+    def __iter__(self):
+        rows = self.connection.execute(
+            "select context from context order by context")
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.connection.execute(
+            "select count(*) from context").fetchone()[0]
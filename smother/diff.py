@@ -27,31 +27,42 @@ def dedup(func):
     return wrapper
 
 
+def _patch_intervals(diff_report, patch):
+    """
+    Return the Intervals changed by one file's patch.
+    """
+    try:
+        old_pf = diff_report.old_file(patch.source_file)
+        new_pf = diff_report.new_file(patch.target_file)
+    except InvalidPythonFile:
+        return []
+
+    result = []
+    for hunk in patch:
+        for line in hunk:
+            if line.line_type == LINE_TYPE_ADDED:
+                idx = line.target_line_no
+                result.append(
+                    ContextInterval(new_pf.filename, new_pf.context(idx)))
+            elif line.line_type == LINE_TYPE_REMOVED:
+                idx = line.source_line_no
+                result.append(
+                    ContextInterval(old_pf.filename, old_pf.context(idx)))
+            elif line.line_type in (LINE_TYPE_EMPTY, LINE_TYPE_CONTEXT):
+                pass
+            else:
+                raise AssertionError("Unexpected line type: %s" % line)
+    return result
+
+
 @dedup
 def parse_intervals(diff_report):
     """
     Parse a diff into an iterator of Intervals.
     """
-
     for patch in diff_report.patch_set:
-        try:
-            old_pf = diff_report.old_file(patch.source_file)
-            new_pf = diff_report.new_file(patch.target_file)
-        except InvalidPythonFile:
-            continue
-
-        for hunk in patch:
-            for line in hunk:
-                if line.line_type == LINE_TYPE_ADDED:
-                    idx = line.target_line_no
-                    yield ContextInterval(new_pf.filename, new_pf.context(idx))
-                elif line.line_type == LINE_TYPE_REMOVED:
-                    idx = line.source_line_no
-                    yield ContextInterval(old_pf.filename, old_pf.context(idx))
-                elif line.line_type in (LINE_TYPE_EMPTY, LINE_TYPE_CONTEXT):
-                    pass
-                else:
-                    raise AssertionError("Unexpected line type: %s" % line)
+        for interval in _patch_intervals(diff_report, patch):
+            yield interval
 
 
 @six.add_metaclass(ABCMeta)
@@ -75,5 +86,11 @@ class DiffReporter(object):
         """
         pass
 
-    def changed_intervals(self):
+    def changed_intervals(self, jobs=1):
+        """
+        Return an iterator of the Intervals changed by the diff.
+
+        Subclasses that can read files from several processes use
+        `jobs` processes. The base class parses patches one by one.
+        """
         return parse_intervals(self)
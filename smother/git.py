@@ -1,10 +1,18 @@
+import multiprocessing
+import threading
 from subprocess import CalledProcessError
 from subprocess import PIPE
 from subprocess import Popen
 
+from more_itertools import unique_justseen
 from unidiff import PatchSet
 
+from smother.diff import _patch_intervals
 from smother.diff import DiffReporter
+from smother.diff import parse_intervals
+from smother.interval import ContextInterval
+from smother.python import CACHE
+from smother.python import InvalidPythonFile
 from smother.python import PythonFile
 
 
@@ -43,16 +51,181 @@ def git_show(ref, path):
     return execute(cmd)
 
 
+class CatFile(object):
+    """
+    Read file contents from git through one long-running
+    `git cat-file --batch` process, instead of running
+    `git show` once per file.
+
+    Blob SHAs are looked up through a second `--batch-check`
+    process, which does not read file contents.
+    """
+
+    def __init__(self):
+        # git cat-file option -> process
+        self.procs = {}
+        # requests and responses must not interleave across threads
+        self.lock = threading.Lock()
+
+    def _request(self, option, ref, path):
+        """
+        Send one request, and return its '<sha> <type> <size>' header
+        split into fields. Must be called with `lock` held.
+        """
+        spec = "{}:{}".format(ref or '', path)
+        proc = self.procs.get(option)
+        if proc is None:
+            proc = self.procs[option] = Popen(
+                ['git', 'cat-file', option], stdin=PIPE, stdout=PIPE)
+
+        proc.stdin.write(spec.encode('utf8') + b'\n')
+        proc.stdin.flush()
+
+        # "<sha> <type> <size>", or "<spec> missing"
+        header = proc.stdout.readline().split()
+        if len(header) != 3:
+            if not header:  # the process died
+                del self.procs[option]
+            raise CalledProcessError(128, "git cat-file " + spec)
+        return proc, header
+
+    def show(self, ref, path):
+        """
+        Return the contents of `path` at `ref`, like `git_show`.
+
+        Raises
+        ------
+        CalledProcessError, if `path` does not exist at `ref`.
+        """
+        with self.lock:
+            proc, header = self._request('--batch', ref, path)
+            contents = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)  # trailing newline
+
+        return contents.decode('utf8')
+
+    def blob(self, ref, path):
+        """
+        Return the SHA of the blob stored for `path` at `ref`.
+
+        Raises
+        ------
+        CalledProcessError, if `path` does not exist at `ref`.
+        """
+        with self.lock:
+            _, header = self._request('--batch-check', ref, path)
+        return header[0].decode('ascii')
+
+    def close(self):
+        with self.lock:
+            for proc in self.procs.values():
+                proc.stdin.close()
+                proc.wait()
+                proc.stdout.close()
+            self.procs.clear()
+
+
+def _memoize(cache, filename, factory):
+    """
+    Return cache[filename], building it with `factory` if needed.
+
+    InvalidPythonFile errors are cached and re-raised too, so that
+    unparseable files are only fetched once.
+    """
+    if filename not in cache:
+        try:
+            cache[filename] = factory()
+        except InvalidPythonFile as exc:
+            cache[filename] = exc
+
+    result = cache[filename]
+    if isinstance(result, InvalidPythonFile):
+        raise result
+    return result
+
+
+# the GitDiffReporter of a worker process in `changed_intervals`
+_worker_reporter = None
+
+
+def _init_worker(ref, cache_directory):
+    global _worker_reporter
+    CACHE.directory = cache_directory
+    _worker_reporter = GitDiffReporter(ref, diff=[])
+
+
+def _worker_intervals(patch):
+    """
+    Return the (filename, context) intervals changed by one patch, and
+    the context tables parsed to find them, so that the parent process
+    does not parse the same files again.
+    """
+    before = set(CACHE.entries)
+    intervals = [
+        tuple(interval)
+        for interval in _patch_intervals(_worker_reporter, patch)
+    ]
+    tables = {
+        key: runs for key, runs in CACHE.entries.items()
+        if key not in before
+    }
+    return intervals, tables
+
+
 class GitDiffReporter(DiffReporter):
 
     def __init__(self, ref='HEAD', diff=None):
         self.ref = ref
-        self._patch_set = diff or git_diff(ref)
+        self._patch_set = git_diff(ref) if diff is None else diff
+        self._cat_file = CatFile()
+
+        # path -> PythonFile or InvalidPythonFile, for each side of the diff
+        self._old_files = {}
+        self._new_files = {}
+
+    def close(self):
+        """
+        Stop the git process used to read old files.
+        """
+        self._cat_file.close()
 
     @property
     def patch_set(self):
         return self._patch_set
 
+    def changed_intervals(self, jobs=1):
+        """
+        Return an iterator of the Intervals changed by the diff.
+
+        Parameters
+        ----------
+        jobs : int (optional, default=1)
+            Number of processes used to fetch and parse the changed
+            files. Each reads from git through its own `CatFile`.
+            Intervals are returned in the order of the patch set
+            regardless.
+        """
+        patches = list(self.patch_set)
+        if jobs <= 1 or len(patches) <= 1:
+            return parse_intervals(self)
+
+        pool = multiprocessing.Pool(
+            min(jobs, len(patches)), initializer=_init_worker,
+            initargs=(self.ref, CACHE.directory))
+        try:
+            results = pool.map(_worker_intervals, patches)
+        finally:
+            pool.close()
+            pool.join()
+
+        for _, tables in results:
+            CACHE.update(tables)
+        return unique_justseen(
+            ContextInterval(*interval)
+            for intervals, _ in results
+            for interval in intervals
+        )
+
     def old_file(self, path):
         if path == '/dev/null':
             return
@@ -63,8 +236,22 @@ class GitDiffReporter(DiffReporter):
         else:
             filename = path
 
-        source = git_show(self.ref, filename)
-        return PythonFile(filename, source=source)
+        return _memoize(self._old_files, filename, lambda: self._old_file(
+            filename))
+
+    def _old_file(self, filename):
+        """
+        Build the PythonFile for `filename` at `ref`.
+
+        Its context table is cached by blob SHA, so when the same
+        revision has been parsed before (in this process, or by an
+        earlier one sharing the cache directory) the file is not read.
+        """
+        prefix = PythonFile._module_name(filename)
+        sha = self._cat_file.blob(self.ref, filename)
+        return PythonFile(
+            filename, prefix=prefix, key=CACHE.blob_key(sha, prefix),
+            source=lambda: self._cat_file.show(self.ref, filename))
 
     def new_file(self, path):
         if path == '/dev/null':
@@ -76,4 +263,5 @@ class GitDiffReporter(DiffReporter):
         else:
             filename = path
 
-        return PythonFile(filename)
+        return _memoize(
+            self._new_files, filename, lambda: PythonFile(filename))
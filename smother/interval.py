@@ -4,22 +4,68 @@
 import re
 from collections import namedtuple
 
+from smother.lineset import LineSet
 from smother.python import PythonFile
 
 NUMBER_RE = re.compile('([0-9]+)(?:-([0-9]+))?')
 
 
+class LineMask(object):
+    """
+    The set of lines in a file that belong to one or more Intervals.
+
+    Testing a set of covered lines against a mask is a single bitwise
+    operation, so several regions in a file can be combined into one
+    mask and compared against every test in one pass.
+    """
+
+    def __init__(self, lines=(), tail=None):
+        """
+        Parameters
+        ----------
+        lines : LineSet or iterable of int
+            The lines in the mask
+        tail : int (optional)
+            If provided, every line from `tail` onwards is also in the mask.
+        """
+        self.lines = LineSet.coerce(lines)
+        self.tail = tail
+
+    def __or__(self, other):
+        tails = [t for t in (self.tail, other.tail) if t is not None]
+        return LineMask(self.lines | other.lines,
+                        min(tails) if tails else None)
+
+    def __contains__(self, line):
+        return line in self.lines or (
+            self.tail is not None and line >= self.tail)
+
+    def intersects(self, lines):
+        lines = LineSet.coerce(lines)
+        if lines.intersects(self.lines):
+            return True
+        return self.tail is not None and bool(lines.bits >> self.tail)
+
+
 class Interval(object):
     """
     Abstract base class to represent a region of code.
     """
 
+    def mask(self, python_file):
+        """
+        Return the `LineMask` of lines in `python_file` that
+        belong to this Interval.
+        """
+        raise NotImplementedError()
+
     def intersects(self, python_file, lines):
         """
         Test whether a `PythonFile` and list of line numbers
         intersects the given Interval.
         """
-        raise NotImplementedError()
+        assert python_file.filename == self.filename
+        return self.mask(python_file).intersects(lines)
 
 
 class LineInterval(namedtuple('LineInterval', 'filename start stop'),
@@ -27,14 +73,9 @@ class LineInterval(namedtuple('LineInterval', 'filename start stop'),
     """
     Interval defined by a right-open interval of 1-offset line numbers.
     """
-    def intersects(self, python_file, lines):
-
-        assert python_file.filename == self.filename
 
-        for line in lines:
-            if (line >= self.start) and (line < self.stop):
-                return True
-        return False
+    def mask(self, python_file):
+        return LineMask(LineSet.from_range(self.start, self.stop))
 
 
 class ContextInterval(namedtuple('ContextInterval', 'filename context'),
@@ -43,13 +84,13 @@ class ContextInterval(namedtuple('ContextInterval', 'filename context'),
     Interval defined by a `context` identifier within a file.
     """
 
-    def intersects(self, python_file, lines):
-        assert python_file.filename == self.filename
+    def mask(self, python_file):
+        lines = python_file.context_mask(self.context)
 
-        for line in lines:
-            if python_file.context(line) == self.context:
-                return True
-        return False
+        # lines after the last python code belong to the module
+        if self.context == python_file.prefix:
+            return LineMask(lines, python_file.line_count + 1)
+        return LineMask(lines)
 
 
 def parse_intervals(path, as_context=False):
@@ -89,7 +130,7 @@ def parse_intervals(path, as_context=False):
 
     def _regions_from_range():
         if as_context:
-            ctxs = list(set(pf.lines[start - 1: stop - 1]))
+            ctxs = list(pf.contexts_between(start, stop))
             return [
                 ContextInterval(filename, ctx)
                 for ctx in ctxs
@@ -117,7 +158,7 @@ def parse_intervals(path, as_context=False):
         return _regions_from_range()
     else:  # specified a context name
         context = pf.prefix + ':' + subpath
-        if context not in pf.lines:
+        if not pf.has_context(context):
             raise ValueError("%s is not a valid context for %s"
                              % (context, pf.prefix))
         if as_context:
@@ -0,0 +1,197 @@
+"""
+Compact sets of line numbers.
+"""
+import binascii
+from collections import deque
+from itertools import compress
+from itertools import count
+from itertools import repeat
+
+from six.moves import map
+
+ONE = ord('1')
+
+
+def _binary_digits():
+    table = bytearray(range(256))
+    table[ord('0')], table[ONE] = 0, 1
+    return bytes(table)
+
+
+# maps the ascii digits of a binary string to 0/1 bytes
+BINARY_DIGITS = _binary_digits()
+
+
+def list_to_bitmap(values):
+    """
+    Return an integer whose set bits are the given positions.
+    """
+    values = values if isinstance(values, list) else list(values)
+    if not values:
+        return 0
+    digits = bytearray(b'0') * (max(values) + 1)
+    deque(map(digits.__setitem__, values, repeat(ONE)), maxlen=0)
+    return int(bytes(digits[::-1]), 2)
+
+
+def bitmap_to_list(bits):
+    """
+    Return the sorted positions of the set bits in an integer.
+    """
+    digits = bytearray(bin(bits)[:1:-1], 'ascii').translate(BINARY_DIGITS)
+    return list(compress(count(), digits))
+
+
+def _from_bytes(data):
+    return int(binascii.hexlify(bytes(data)[::-1]) or b'0', 16)
+
+
+def _to_bytes(bits):
+    if not bits:
+        return b''
+    digits = '%x' % bits
+    return binascii.unhexlify('0' * (len(digits) % 2) + digits)[::-1]
+
+
+if hasattr(int, 'from_bytes'):
+    def bitmap_from_bytes(data):
+        """
+        Return the integer stored in a little-endian bitmap.
+        """
+        return int.from_bytes(data, 'little')
+
+    def bitmap_to_bytes(bits):
+        """
+        Return an integer as a little-endian bitmap of minimal length.
+        """
+        return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+else:  # python 2
+    bitmap_from_bytes = _from_bytes
+    bitmap_to_bytes = _to_bytes
+
+
+def _count_bits(bits):
+    return bin(bits).count('1')
+
+
+# the number of set bits in an integer. int.bit_count is much faster,
+# where available (python 3.10+)
+popcount = getattr(int, 'bit_count', _count_bits)
+
+
+class LineSet(object):
+    """
+    An immutable set of non-negative integers, stored as a bitmap.
+
+    Bit `n` of `bits` is set when line `n` is in the set. Python
+    integers are arbitrary-precision, so unions and intersections
+    are single bitwise operations on the whole set.
+
+    LineSets iterate in ascending order, and compare equal to any
+    sequence containing the same line numbers. This keeps them
+    interchangeable with the sorted line lists used by older code.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, lines=()):
+        """
+        Parameters
+        ----------
+        lines : iterable of int
+        """
+        if isinstance(lines, LineSet):
+            self.bits = lines.bits
+        else:
+            self.bits = list_to_bitmap(lines)
+
+    @classmethod
+    def coerce(cls, lines):
+        """
+        Return `lines` as a LineSet, without copying LineSets.
+        """
+        if isinstance(lines, cls):
+            return lines
+        return cls(lines)
+
+    @classmethod
+    def from_bits(cls, bits):
+        result = cls.__new__(cls)
+        result.bits = bits
+        return result
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Build a LineSet from a little-endian bitmap.
+        """
+        return cls.from_bits(bitmap_from_bytes(data))
+
+    @classmethod
+    def from_range(cls, start, stop):
+        """
+        Build a LineSet spanning the right-open interval [start, stop).
+        """
+        if stop <= start:
+            return cls()
+        return cls.from_bits(((1 << (stop - start)) - 1) << start)
+
+    def to_bytes(self):
+        """
+        Return the set as a little-endian bitmap.
+        """
+        return bitmap_to_bytes(self.bits)
+
+    def intersects(self, other):
+        return bool(self.bits & self.coerce(other).bits)
+
+    def __iter__(self):
+        return iter(bitmap_to_list(self.bits))
+
+    def __len__(self):
+        return popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, line):
+        return line >= 0 and bool(self.bits >> line & 1)
+
+    def __or__(self, other):
+        return self.from_bits(self.bits | self.coerce(other).bits)
+
+    def __and__(self, other):
+        return self.from_bits(self.bits & self.coerce(other).bits)
+
+    def __sub__(self, other):
+        return self.from_bits(self.bits & ~self.coerce(other).bits)
+
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __eq__(self, other):
+        if isinstance(other, LineSet):
+            return self.bits == other.bits
+        try:
+            return self.bits == list_to_bitmap(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __reduce__(self):
+        return (self.__class__, (), self.bits)
+
+    def __setstate__(self, bits):
+        self.bits = bits
+
+    def __repr__(self):
+        return 'LineSet(%r)' % list(self)
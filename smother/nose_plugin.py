@@ -1,4 +1,5 @@
 import logging
+import time
 
 from nose.plugins.cover import Coverage
 
@@ -13,7 +14,8 @@ class SmotherNose(Coverage):
 
     def afterTest(self, test):
         self.coverInstance.stop()
-        self.smother.save_context("%s:%s" % test.address()[1:3])
+        self.smother.save_context("%s:%s" % test.address()[1:3],
+                                  time.time() - self.started)
 
     def beforeTest(self, test):
 
@@ -24,6 +26,7 @@ class SmotherNose(Coverage):
             self.smother.save_context("")
             self.first_test = False
 
+        self.started = time.time()
         self.smother.start()
 
     def configure(self, options, conf):
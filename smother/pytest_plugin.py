@@ -1,4 +1,9 @@
+import os
+import shutil
+import time
+
 import coverage
+import pytest
 
 
 def pytest_addoption(parser):
@@ -18,26 +23,109 @@ def pytest_addoption(parser):
     group.addoption('--smother-output', action='store', default='.smother',
                     help='output file for smother data. '
                          'default: .smother')
+    group.addoption('--smother-format', action='store', default=None,
+                    choices=['binary', 'json', 'sqlite'],
+                    help='format of the smother output. default: sqlite '
+                         'for .db and .sqlite files, json for .json files, '
+                         'and binary otherwise')
     group.addoption('--smother-cover', action='store_true', default=False,
                     help='Create a vanilla coverage file in addition to '
                          'the smother output')
+    group.addoption('--smother-stream', action='store_true', default=False,
+                    help='Write each test to the smother output as soon '
+                         'as it finishes, instead of at the end of the '
+                         'session. default: False')
+    group.addoption('--smother-select', action='store', default=None,
+                    metavar='REF',
+                    help='Only run tests which, according to the report at '
+                         '--smother-output, run code changed since the git '
+                         'ref REF. Tests missing from the report, and tests '
+                         'in changed files, are always run. Implies '
+                         '--smother-append.')
+    group.addoption('--smother-contexts', action='store_true', default=False,
+                    help='Record each test as a coverage.py dynamic context '
+                         'instead of restarting coverage around every test. '
+                         'The smother output is a coverage.py data file. '
+                         'Requires coverage 5 or later. default: False')
 
 
 def pytest_configure(config):
     """Activate plugin if appropriate."""
+    if config.getvalue('smother_select') is not None:
+        # the report that selects tests is also the one --smother writes,
+        # so keep the coverage of the tests which are deselected
+        config.option.smother_append = True
+        if not config.pluginmanager.hasplugin('_smother_select'):
+            config.pluginmanager.register(
+                Selector(config.option), '_smother_select')
+
     if config.getvalue('smother_source'):
         if not config.pluginmanager.hasplugin('_smother'):
-            plugin = Plugin(config.option)
+            worker = _xdist_worker(config)
+            if worker is None and config.getoption('dist', 'no') != 'no':
+                plugin = XdistController(config.option)
+            else:
+                plugin = Plugin(config.option, worker=worker)
             config.pluginmanager.register(plugin, '_smother')
 
 
+def _xdist_worker(config):
+    """
+    Return the id of this pytest-xdist worker, or None if this
+    process is not an xdist worker.
+    """
+    # pytest-xdist < 2 called workers slaves
+    workerinput = getattr(config, 'workerinput',
+                          getattr(config, 'slaveinput', None))
+    if workerinput is None:
+        return None
+    return workerinput.get('workerid', workerinput.get('slaveid'))
+
+
+def _check_options(options):
+    if options.smother_contexts:
+        if not hasattr(coverage.Coverage, 'switch_context'):
+            raise pytest.UsageError(
+                "--smother-contexts requires coverage 5 or later")
+        if options.smother_stream or options.smother_cover:
+            raise pytest.UsageError(
+                "--smother-contexts writes a coverage.py data file, "
+                "and cannot be combined with --smother-stream "
+                "or --smother-cover")
+
+
 class Plugin(object):
 
-    def __init__(self, options):
-        self.coverage = coverage.coverage(
-            source=options.smother_source,
-            config_file=options.smother_config,
-        )
+    def __init__(self, options, worker=None):
+        _check_options(options)
+        self.contexts = options.smother_contexts
+        self.worker = worker
+        self.output = options.smother_output
+        self.append = options.smother_append
+        self.cover_report = options.smother_cover
+        self.format = options.smother_format
+
+        if worker is not None:
+            # each xdist worker writes a private shard, which the
+            # controller merges into the output once all workers finish
+            self.output = '%s.%s' % (self.output, worker)
+            self.append = False
+            self.cover_report = False
+            if not self.contexts:
+                self.format = 'binary'
+
+        if self.contexts:
+            self.coverage = coverage.coverage(
+                source=options.smother_source,
+                config_file=options.smother_config,
+                data_file=self.output,
+                auto_data=self.append,
+            )
+        else:
+            self.coverage = coverage.coverage(
+                source=options.smother_source,
+                config_file=options.smother_config,
+            )
 
         # The unusual import statement placement is so that
         # smother's own test suite can measure coverage of
@@ -45,24 +133,208 @@ class Plugin(object):
         self.coverage.start()
         from smother.control import Smother
         self.smother = Smother(self.coverage)
-
-        self.output = options.smother_output
-        self.append = options.smother_append
-        self.cover_report = options.smother_cover
         self.first_test = True
 
+        if options.smother_stream:
+            self.output = self.smother.stream(
+                self.output, self.append, format=self.format)
+
+    # run before pytest sets up fixtures, and before it runs their
+    # finalizers, so that the test's context covers exactly the same
+    # code as in the default mode
+    @pytest.hookimpl(tryfirst=True)
     def pytest_runtest_setup(self, item):
+        if self.contexts:
+            # coverage keeps running, and labels lines with the test
+            self.coverage.switch_context(item.nodeid)
+            self.started = time.time()
+            return
+
         if self.first_test:
             self.first_test = False
             self.coverage.stop()
             self.smother.save_context("")
+        self.started = time.time()
         self.smother.start()
 
+    @pytest.hookimpl(tryfirst=True)
     def pytest_runtest_teardown(self, item, nextitem):
+        duration = time.time() - self.started
+        if self.contexts:
+            # code run between and after tests, like fixture finalizers,
+            # is labeled like code run before the first test
+            self.coverage.switch_context('')
+            self.smother.durations[item.nodeid] = duration
+            return
         self.coverage.stop()
-        self.smother.save_context(item.nodeid)
+        self.smother.save_context(item.nodeid, duration)
+
+    def pytest_sessionfinish(self, session):
+        if self.worker is None:
+            return
+
+        # this runs inside xdist's own sessionfinish hook, before
+        # it sends workeroutput to the controller
+        shard = self._save()
+        workeroutput = getattr(session.config, 'workeroutput',
+                               getattr(session.config, 'slaveoutput', {}))
+        workeroutput['smother_shard'] = os.path.abspath(shard)
 
     def pytest_terminal_summary(self):
-        self.smother.write(self.output, append=self.append)
+        if self.worker is None:
+            self._save()
+
+    def _save(self):
+        """
+        Write the smother output, and return its path.
+        """
+        if self.contexts:
+            from smother import coverage_db
+            self.coverage.stop()
+            self.coverage.save()
+            path = self.coverage.get_data().data_filename()
+            coverage_db.write(path, {}, append=True,
+                              durations=self.smother.durations)
+            return path
+
+        if self.smother.writer is not None:
+            # the controller merges shards, so compacting them is wasted
+            self.smother.close_stream(compact=self.worker is None)
+            if self.cover_report:
+                self.smother.data = self.smother.load(self.output).data
+        elif self.worker is not None:
+            # shards are private, so skip locking and parallel suffixes
+            with open(self.output, 'wb') as outfile:
+                self.smother.write(outfile, format=self.format)
+        else:
+            self.smother.write(
+                self.output, append=self.append, format=self.format)
+
         if self.cover_report:
             self.smother.write_coverage()
+        return self.output
+
+
+class XdistController(object):
+    """
+    Runs in the pytest-xdist controller, which does not run tests.
+    Each worker writes its coverage to a private shard, and they are
+    merged into the smother output once, after every worker finishes.
+    """
+
+    def __init__(self, options):
+        _check_options(options)
+        self.options = options
+        self.shards = []
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        workeroutput = getattr(node, 'workeroutput',
+                               getattr(node, 'slaveoutput', {}))
+        shard = workeroutput.get('smother_shard')
+        if shard is not None:
+            self.shards.append(shard)
+
+    def pytest_sessionfinish(self):
+        from portalocker import Lock
+        from smother import storage
+        from smother.control import Smother
+
+        options = self.options
+        output = options.smother_output
+        format = options.smother_format or storage.format_for_path(output)
+        if options.smother_contexts:
+            format = storage.SQLITE
+
+        smother = Smother()
+        if format == storage.BINARY and not options.smother_append:
+            # stream every shard into the output in one pass
+            smother.combine(sorted(self.shards), output)
+        elif format == storage.BINARY:
+            # other processes may be appending too, so add the shards as
+            # segments instead of replacing the report, then compact it
+            # unless one of them holds the lock
+            with Lock(output, mode='ab', timeout=10,
+                      fail_when_locked=False) as outfile:
+                for shard in sorted(self.shards):
+                    with open(shard, 'rb') as infile:
+                        shutil.copyfileobj(infile, outfile)
+            Smother.try_compact(output)
+        else:
+            for shard in sorted(self.shards):
+                smother |= Smother.load(shard)
+            smother.write(output, append=options.smother_append,
+                          format=format)
+
+        for shard in self.shards:
+            os.remove(shard)
+
+        if options.smother_cover:
+            smother = Smother(coverage.coverage(
+                config_file=options.smother_config))
+            smother.data = Smother.load(output).data
+            smother.write_coverage()
+
+
+class Selector(object):
+    """
+    Deselect the tests that a git diff cannot affect, the way
+    `smother diff` selects them, without leaving pytest.
+    """
+
+    def __init__(self, options):
+        self.ref = options.smother_select
+        self.report = options.smother_output
+
+    def affected(self):
+        """
+        Return the tests in the report which run changed code, the
+        set of tests in the report, and the absolute paths of the
+        changed files.
+        """
+        from smother.control import Smother
+        from smother.git import GitDiffReporter
+
+        if not os.path.exists(self.report):
+            raise pytest.UsageError(
+                "--smother-select needs a report of which code each test "
+                "runs, but %s does not exist. Run the tests with "
+                "--smother first, or point --smother-output at a report."
+                % self.report)
+
+        smother = Smother.load(self.report, lazy=True)
+        diff = GitDiffReporter(self.ref)
+        try:
+            regions = diff.changed_intervals()
+            result = smother.query_context(regions, file_factory=diff.old_file)
+            changed = {
+                os.path.abspath(patch.path) for patch in diff.patch_set
+            }
+            return set(result.contexts), set(smother.data), changed
+        finally:
+            diff.close()
+            close = getattr(smother.data, 'close', None)
+            if close is not None:
+                close()
+
+    def pytest_collection_modifyitems(self, config, items):
+        affected, known, changed = self.affected()
+
+        # "" holds coverage from before the first test, like module
+        # imports, which can't be attributed to particular tests
+        if '' in affected:
+            return
+
+        selected = []
+        deselected = []
+        for item in items:
+            path = str(getattr(item, 'path', None) or item.fspath)
+            if (item.nodeid in affected or item.nodeid not in known or
+                    os.path.abspath(path) in changed):
+                selected.append(item)
+            else:
+                deselected.append(item)
+
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = selected
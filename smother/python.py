@@ -1,12 +1,23 @@
 """
 Module for parsing python code
 """
+import hashlib
+import json
 import os
+import platform
 import re
 import sys
 from ast import iter_child_nodes
 from ast import NodeVisitor
 from ast import parse
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import groupby
+
+import six
+
+from smother.lineset import LineSet
 
 
 SUFFIX_RE = re.compile('/?(__init__)?\.py[cwo]?')
@@ -96,23 +107,156 @@ class Visitor(NodeVisitor):
     visit_AsyncFunctionDef = _add_section
 
 
+class ContextCache(object):
+    """
+    Cache the context tables of python files, keyed by a hash of their
+    source code, or by the git blob SHA which already names it.
+
+    Recently used tables are kept in memory. If `directory` is set,
+    tables are also stored on disk, so that later processes can skip
+    parsing files which have not changed.
+    """
+
+    # bump when Visitor output changes, to invalidate on-disk entries
+    VERSION = 1
+
+    # the ast, and so the Visitor output, depends on the interpreter
+    PYTHON = '%s-%i.%i' % (
+        platform.python_implementation(), sys.version_info[0],
+        sys.version_info[1])
+
+    def __init__(self, maxsize=256, directory=None):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            Number of tables to keep in memory
+        directory : str (optional)
+            Where to store tables on disk. If None, only cache in memory.
+        """
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, source, prefix, kind='source'):
+        digest = hashlib.sha1()
+        for part in (str(self.VERSION), self.PYTHON, kind, prefix, source):
+            if isinstance(part, six.text_type):
+                part = part.encode('utf8')
+            digest.update(part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def blob_key(self, sha, prefix):
+        """
+        Key for the file stored in git as blob `sha`, which can be
+        looked up without reading the file.
+        """
+        return self.key(sha, prefix, kind='blob')
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """
+        Return the cached context table for `key`, or None.
+
+        Tables are lists of (context, line count) runs.
+        """
+        runs = self.entries.pop(key, None)
+        if runs is not None:
+            self.hits += 1
+            self.entries[key] = runs
+            return runs
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key)) as infile:
+                    runs = [tuple(run) for run in json.load(infile)]
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                self.disk_hits += 1
+                self._remember(key, runs)
+                return runs
+
+        self.misses += 1
+
+    def put(self, key, runs):
+        self._remember(key, runs)
+        if self.directory is None:
+            return
+
+        path = self._path(key)
+        tmppath = "%s.%i.tmp" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmppath, 'w') as outfile:
+                json.dump(runs, outfile)
+            os.rename(tmppath, path)
+        except (IOError, OSError):  # the cache is best-effort
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def update(self, tables):
+        """
+        Add {key: runs} tables built by another process to the
+        in-memory cache.
+        """
+        for key, runs in tables.items():
+            self._remember(key, runs)
+
+    def _remember(self, key, runs):
+        self.entries[key] = runs
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Empty the in-memory cache, and reset the statistics.
+        """
+        self.entries.clear()
+        self.hits = self.disk_hits = self.misses = 0
+
+    @property
+    def stats(self):
+        return OrderedDict([
+            ('hits', self.hits),
+            ('disk_hits', self.disk_hits),
+            ('misses', self.misses),
+        ])
+
+
+# shared by every PythonFile
+CACHE = ContextCache()
+
+
 class PythonFile(object):
     """
     A file of python source.
     """
-    def __init__(self, filename, source=None, prefix=None):
+    def __init__(self, filename, source=None, prefix=None, key=None):
         """
         Parameters
         ----------
         filename : str
             The path to the file
-        source : str (optional)
-            The contents of the file. Will be read from `filename`
-            if not provided.
+        source : str or callable (optional)
+            The contents of the file, or a function returning them.
+            Will be read from `filename` if not provided.
         prefix : str (optional)
             Name to give to the outermost context in the file.
             If not provided, will be the "." form of filename
             (ie a/b/c.py -> a.b.c)
+        key : str (optional)
+            Context cache key for the file, from `ContextCache.blob_key`.
+            If not provided, the key is a hash of `source`. When the
+            key is cached and `source` is callable, it is only called
+            if `source` is accessed.
         """
         self.filename = filename
 
@@ -123,19 +267,74 @@ class PythonFile(object):
 
         if source is None:
             with open(filename) as infile:
-                self.source = infile.read()
-        else:
-            self.source = source
+                source = infile.read()
+        self._source = source
+
+        if key is None:
+            key = CACHE.key(self.source, self.prefix)
+        runs = CACHE.get(key)
+        if runs is None:
+            visitor = Visitor(prefix=self.prefix)
+            visitor.visit(self.ast)
+            runs = [
+                (context, len(list(group)))
+                for context, group in groupby(visitor.lines)
+            ]
+            CACHE.put(key, runs)
+
+        self._build_table(runs)
+
+    def _build_table(self, runs):
+        """
+        Store the context of each line as blocks of consecutive lines.
 
+        `starts` holds the first line of each block, and `ids` the
+        index of its context in `contexts`. `spans` maps each context
+        to the first and last+1 lines of the blocks it labels.
+        """
+        self.contexts = []
+        self.starts = []
+        self.ids = []
+        self.spans = {}
+        ids = {}
+
+        start = 1
+        for context, count in runs:
+            if context not in ids:
+                ids[context] = len(self.contexts)
+                self.contexts.append(context)
+            self.starts.append(start)
+            self.ids.append(ids[context])
+
+            stop = start + count
+            lo, _ = self.spans.get(context, (start, stop))
+            self.spans[context] = (lo, stop)
+            start = stop
+
+        self.line_count = start - 1
+        self._context_ids = ids
+        self._names = sorted(self.contexts)
+        self._ranges = {}
+        self._masks = {}
+        self._id_sets = {}
+
+    @property
+    def source(self):
+        if callable(self._source):
+            self._source = self._source()
+        return self._source
+
+    @property
+    def ast(self):
+        """
+        The parsed module. Files whose contexts are cached are only
+        parsed when this is accessed.
+        """
         try:
-            self.ast = parse(self.source)
+            return parse(self.source)
         except SyntaxError:
             raise InvalidPythonFile(self.filename)
 
-        visitor = Visitor(prefix=self.prefix)
-        visitor.visit(self.ast)
-        self.lines = visitor.lines
-
     @staticmethod
     def _module_name(filename):
         """
@@ -173,8 +372,67 @@ class PythonFile(object):
             raise ValueError("Module not found: %s" % module_name)
 
     @property
-    def line_count(self):
-        return len(self.lines)
+    def lines(self):
+        """
+        The context name of each line in the file.
+        """
+        return [
+            self.contexts[idx]
+            for idx, start, stop in zip(
+                self.ids, self.starts, self.starts[1:] + [self.line_count + 1])
+            for _ in range(start, stop)
+        ]
+
+    def context_mask(self, context):
+        """
+        Return the LineSet of lines whose context is exactly `context`.
+        """
+        mask = self._masks.get(context)
+        if mask is None:
+            mask = LineSet()
+            stops = self.starts[1:] + [self.line_count + 1]
+            target = self._context_ids.get(context)
+            for idx, start, stop in zip(self.ids, self.starts, stops):
+                if idx == target:
+                    mask |= LineSet.from_range(start, stop)
+            self._masks[context] = mask
+        return mask
+
+    def context_ids(self, lines):
+        """
+        Return the contexts of `lines`, as a LineSet of indices into
+        `contexts`. Like `context`, lines outside the file belong to
+        the outermost context.
+        """
+        lines = LineSet.coerce(lines)
+        result = self._id_sets.get(lines)
+        if result is None:
+            outer = self._context_ids.get(self.prefix, len(self.contexts))
+            ids = set()
+            for line in lines:
+                if line < 1 or line > self.line_count:
+                    ids.add(outer)
+                else:
+                    ids.add(self.ids[bisect_right(self.starts, line) - 1])
+            result = self._id_sets[lines] = LineSet(ids)
+        return result
+
+    def has_context(self, context):
+        """
+        Whether any line in the file has the given context name.
+        """
+        return context in self.spans
+
+    def contexts_between(self, start, stop):
+        """
+        Return the set of context names for lines in [start, stop).
+        """
+        idx = max(bisect_right(self.starts, start) - 1, 0)
+        result = set()
+        while idx < len(self.starts) and self.starts[idx] < stop:
+            result.add(self.contexts[self.ids[idx]])
+            idx += 1
+        return result
 
     def context_range(self, context):
         """
@@ -192,20 +450,26 @@ class PythonFile(object):
         if not context.startswith(self.prefix):
             context = self.prefix + '.' + context
 
-        lo = hi = None
-        for idx, line_context in enumerate(self.lines, 1):
+        if context in self._ranges:
+            return self._ranges[context]
 
-            # context is hierarchical -- context spans itself
-            # and any suffix.
-            if line_context.startswith(context):
-                lo = lo or idx
-                hi = idx
+        # context is hierarchical -- context spans itself
+        # and any suffix. Those names are adjacent once sorted.
+        lo = hi = None
+        idx = bisect_left(self._names, context)
+        while (idx < len(self._names) and
+               self._names[idx].startswith(context)):
+            start, stop = self.spans[self._names[idx]]
+            lo = start if lo is None else min(lo, start)
+            hi = stop if hi is None else max(hi, stop)
+            idx += 1
 
         if lo is None:
             raise ValueError("Context %s does not exist in file %s" %
                              (context, self.filename))
 
-        return lo, hi + 1
+        self._ranges[context] = lo, hi
+        return lo, hi
 
     def context(self, line):
         """
@@ -214,11 +478,11 @@ class PythonFile(object):
         # XXX due to a limitation in Visitor,
         # non-python code after the last python code
         # in a file is not added to self.lines, so we
-        # have to guard against IndexErrors.
-        idx = line - 1
-        if idx >= len(self.lines):
+        # treat it as module-level code.
+        if line < 1 or line > self.line_count:
             return self.prefix
-        return self.lines[idx]
+        idx = bisect_right(self.starts, line) - 1
+        return self.contexts[self.ids[idx]]
 
 
 if __name__ == "__main__":
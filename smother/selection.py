@@ -0,0 +1,184 @@
+"""
+Choosing which of the tests in a smother report to run.
+"""
+import heapq
+
+from smother.lineset import LineSet
+from smother.lineset import popcount
+
+
+def weights(tests, durations):
+    """
+    Return the {test: seconds} duration of each test.
+
+    Tests without a recorded duration are assumed to take the mean
+    duration of the tests with one, or 1 second if none have one.
+    """
+    known = [durations[test] for test in tests if test in durations]
+    default = sum(known) / len(known) if known else 1.0
+    return {test: durations.get(test, default) for test in tests}
+
+
+def shard(tests, durations, count):
+    """
+    Partition tests into groups of near-equal total duration.
+
+    Tests are assigned longest first, each to the group with the
+    least total duration so far. The result only depends on the
+    tests and their durations, so every machine sharding the same
+    selection computes the same groups.
+
+    Parameters
+    ----------
+    tests : iterable of str
+        The tests to partition
+    durations : dict
+        {test: seconds} recorded durations (see `weights`)
+    count : int
+        Number of groups
+
+    Returns
+    -------
+    A list of `count` sorted lists of tests.
+    """
+    cost = weights(tests, durations)
+    groups = [[] for _ in range(count)]
+    heap = [(0.0, idx) for idx in range(count)]
+
+    for test in sorted(cost, key=lambda test: (-cost[test], test)):
+        total, idx = heapq.heappop(heap)
+        groups[idx].append(test)
+        heapq.heappush(heap, (total + cost[test], idx))
+
+    return [sorted(group) for group in groups]
+
+
+def budget(covers, durations, seconds):
+    """
+    Choose tests which cover as many units (such as changed regions)
+    as possible, within a time budget.
+
+    Tests are chosen greedily, by the number of not yet covered units
+    they add per second. The ratios only shrink as units are covered,
+    so they are kept in a heap and only re-evaluated when a test
+    reaches the top (lazy greedy evaluation), instead of rescoring
+    every test after each choice. If a single affordable test covers
+    more units than the greedy choice, it is used instead.
+
+    Parameters
+    ----------
+    covers : dict
+        {test: set of units} the units covered by each test
+    durations : dict
+        {test: seconds} recorded durations (see `weights`)
+    seconds : float
+        The time budget
+
+    Returns
+    -------
+    The sorted list of chosen tests, the set of units they cover,
+    and their total duration.
+    """
+    cost = weights(covers, durations)
+    affordable = [
+        test for test, units in covers.items()
+        if units and cost[test] <= seconds
+    ]
+
+    heap = [(-_ratio(len(covers[test]), cost[test]), test)
+            for test in affordable]
+    heapq.heapify(heap)
+
+    chosen = []
+    covered = set()
+    spent = 0.0
+    while heap:
+        _, test = heapq.heappop(heap)
+        if spent + cost[test] > seconds:
+            continue  # the remaining budget only shrinks
+        gain = len(covers[test] - covered)
+        if not gain:
+            continue
+        ratio = _ratio(gain, cost[test])
+        if heap and ratio < -heap[0][0]:
+            heapq.heappush(heap, (-ratio, test))
+            continue
+        chosen.append(test)
+        covered.update(covers[test])
+        spent += cost[test]
+
+    if affordable:
+        best = min(affordable, key=lambda test: (-len(covers[test]), test))
+        if len(covers[best]) > len(covered):
+            return [best], set(covers[best]), cost[best]
+
+    return sorted(chosen), covered, spent
+
+
+def _ratio(gain, cost):
+    return gain / max(cost, 1e-9)
+
+
+def minimize(covers, durations=None):
+    """
+    Choose a small set of tests with the same combined coverage as all
+    of them (greedy set cover).
+
+    The test covering the most units not yet covered is chosen until
+    nothing is left, breaking ties in favor of faster tests. As in
+    `budget`, the number of new units a test covers only shrinks, so
+    tests are rescored lazily as they reach the top of a heap.
+
+    Parameters
+    ----------
+    covers : dict
+        {test: {key: LineSet}} units covered by each test, such as the
+        lines of each source file
+    durations : dict (optional)
+        {test: seconds} recorded durations (see `weights`)
+
+    Returns
+    -------
+    The sorted list of chosen tests, and their combined
+    {key: LineSet} coverage.
+    """
+    cost = weights(covers, durations or {})
+    covered = {}
+
+    # work on the raw bitmaps, trimming each test's entry down to its
+    # uncovered units whenever it is rescored
+    remaining = {
+        test: {key: LineSet.coerce(lines).bits
+               for key, lines in cover.items()}
+        for test, cover in covers.items()
+    }
+
+    def gain(test):
+        left = {}
+        for key, bits in remaining[test].items():
+            bits &= ~covered.get(key, 0)
+            if bits:
+                left[key] = bits
+        remaining[test] = left
+        return sum(map(popcount, left.values()))
+
+    heap = [(-gain(test), cost[test], test) for test in covers]
+    heap = [entry for entry in heap if entry[0]]
+    heapq.heapify(heap)
+
+    chosen = []
+    while heap:
+        _, seconds, test = heapq.heappop(heap)
+        entry = (-gain(test), seconds, test)
+        if not entry[0]:
+            continue
+        if heap and entry > heap[0]:
+            heapq.heappush(heap, entry)
+            continue
+        chosen.append(test)
+        for key, bits in remaining[test].items():
+            covered[key] = covered.get(key, 0) | bits
+
+    return sorted(chosen), {
+        key: LineSet.from_bits(bits) for key, bits in covered.items()
+    }
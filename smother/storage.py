@@ -0,0 +1,1080 @@
+"""
+Serialization of smother reports.
+
+Reports are written in a compact, versioned binary format. Reports
+written as JSON by earlier versions of smother remain readable, and
+`load` detects which format a file uses.
+
+A binary report is made of one or more self-contained *segments*.
+Appending to a report adds a segment, and readers merge the coverage of
+all segments (see `compact`)::
+
+    MAGIC VERSION                  header
+    section payloads               (see below)
+    table of contents              section name -> (offset, length)
+    TOC_OFFSET SEGMENT_LENGTH MAGIC  trailer
+
+All offsets are relative to the start of the segment, so segments
+can be concatenated and a file is parsed by walking trailers backwards
+from the end of the file. The sections of a segment are:
+
+    tests      NUL-terminated, utf8 test context names
+    files      NUL-terminated, utf8 source file paths
+    contexts   per test: index of its first directory entry, entry count
+    directory  per (test, file): file id, offset into `lines`
+    lines      encoded line sets (see `encode_set`)
+    postings   per file: offset into `index`. Optional.
+    index      per file: the set of covered lines, followed by the
+               ids of the tests covering each of those lines. Optional.
+    durations  per test: wall time in seconds, as a double (NaN if
+               unknown). Only written if some test has a duration.
+
+Within a test, directory entries appear in the order files were
+written. Sets of line numbers (and test ids) are stored either as
+fixed-width arrays of deltas or as bitmaps, whichever is smaller.
+
+The `index` inverts the coverage data, so that finding the tests
+which cover part of a file only reads the postings for that file.
+Building it costs more than writing the coverage itself, so it is
+only written by `merge` and `compact` (and so by `smother combine`),
+not by every test process appending to a report. Readers scan the
+coverage of segments without an index instead.
+"""
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+from io import BytesIO
+from io import TextIOBase
+from itertools import groupby
+from itertools import repeat
+from operator import itemgetter
+from operator import sub
+from tempfile import TemporaryFile
+
+import six
+from six.moves import map
+from six.moves.collections_abc import Mapping
+
+from smother.lineset import bitmap_to_list
+from smother.lineset import LineSet
+from smother.lineset import popcount
+MAGIC = b'\x93SMOTHER'
+VERSION = 1
+
+BINARY = 'binary'
+JSON = 'json'
+FORMATS = (BINARY, JSON)
+
+# SQLite reports are databases rather than serialized files; see
+# `smother.coverage_db`
+SQLITE = 'sqlite'
+SQLITE_EXTENSIONS = ('.db', '.sqlite')
+
+HEADER = struct.Struct('<8sH')
+TRAILER = struct.Struct('<QQ8s')
+CONTEXT = struct.Struct('<II')
+ENTRY = struct.Struct('<IQ')
+POSTINGS = struct.Struct('<Q')
+DURATION = struct.Struct('<d')
+
+# set encodings: fixed-width deltas (by byte width) or a bitmap
+DELTA_CODES = {1: 0, 2: 1, 4: 2, 8: 4}
+WIDTHS = {code: width for width, code in DELTA_CODES.items()}
+BITMAP = 3
+COUNTS = DELTA_CODES[4]
+
+SEPARATOR = u'\0'
+
+
+def _typecode(itemsize):
+    for code in 'BHILQ':
+        if array(code).itemsize == itemsize:
+            return code
+    raise AssertionError("No array typecode of size %i" % itemsize)
+
+
+TYPECODES = {
+    code: _typecode(size) for size, code in six.iteritems(DELTA_CODES)
+}
+
+
+try:
+    from itertools import accumulate
+except ImportError:  # python 2
+    def accumulate(values):
+        total = 0
+        for value in values:
+            total += value
+            yield total
+
+
+def iter_unpack(fmt, buf):
+    """
+    Iterate over the records of `fmt` (a struct.Struct) packed in `buf`.
+    """
+    if hasattr(fmt, 'iter_unpack'):
+        return fmt.iter_unpack(buf)
+    # python < 3.4
+    return (fmt.unpack_from(buf, pos) for pos in range(0, len(buf), fmt.size))
+
+
+def encode_varint(value):
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def decode_varint(buf, pos):
+    """
+    Decode a varint from `buf` at `pos`.
+
+    Returns
+    -------
+    value, position of the next byte
+    """
+    result = shift = 0
+    while True:
+        byte = six.indexbytes(buf, pos)
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _pack_array(code, values):
+    arr = array(TYPECODES[code], values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    if six.PY2:
+        return arr.tostring()
+    return arr.tobytes()
+
+
+def _unpack_array(code, payload):
+    arr = array(TYPECODES[code])
+    if six.PY2:
+        arr.fromstring(bytes(payload))
+    else:
+        arr.frombytes(payload)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def _width(largest):
+    """
+    The number of bytes needed to store integers up to `largest`.
+    """
+    if largest < 1 << 8:
+        return 1
+    elif largest < 1 << 16:
+        return 2
+    elif largest < 1 << 32:
+        return 4
+    return 8
+
+
+def encode_set(values):
+    """
+    Encode a sorted sequence of distinct, non-negative integers.
+
+    The result is self-delimiting: a code byte, the varint length
+    of the payload, then the payload.
+    """
+    if not values:
+        return b'\x00\x00'
+
+    deltas = [values[0]]
+    deltas.extend(map(sub, values[1:], values))
+    width = _width(max(deltas))
+    bitmap_bytes = values[-1] // 8 + 1
+
+    if bitmap_bytes < width * len(deltas):
+        code = BITMAP
+        payload = LineSet(values).to_bytes()
+    else:
+        code = DELTA_CODES[width]
+        payload = _pack_array(code, deltas)
+
+    return six.int2byte(code) + encode_varint(len(payload)) + payload
+
+
+def encode_lineset(lines):
+    """
+    Encode a LineSet, as `encode_set` would encode its sorted lines.
+
+    The choice of encoding is made from the bitmap itself, so the
+    lines are only listed when they are delta-encoded.
+    """
+    bits = lines.bits
+    if not bits:
+        return b'\x00\x00'
+
+    size = (bits.bit_length() + 7) // 8
+    # deltas take at least a byte per line, so a bitmap with fewer
+    # bytes than lines is always the smaller encoding
+    if size >= popcount(bits):
+        values = bitmap_to_list(bits)
+        deltas = [values[0]]
+        deltas.extend(map(sub, values[1:], values))
+        width = _width(max(deltas))
+        if size >= width * len(deltas):
+            code = DELTA_CODES[width]
+            payload = _pack_array(code, deltas)
+            return six.int2byte(code) + encode_varint(len(payload)) + payload
+
+    payload = lines.to_bytes()
+    return six.int2byte(BITMAP) + encode_varint(len(payload)) + payload
+
+
+def decode_set(buf, pos=0):
+    """
+    Decode a set written by `encode_set` from `buf` at `pos`.
+
+    Returns
+    -------
+    sorted list of integers, position of the next byte
+    """
+    code = six.indexbytes(buf, pos)
+    length, start = decode_varint(buf, pos + 1)
+    end = start + length
+    payload = buf[start:end]
+
+    if code == BITMAP:
+        values = list(LineSet.from_bytes(payload))
+    elif code in TYPECODES:
+        values = list(accumulate(_unpack_array(code, payload)))
+    else:
+        raise ValueError("Unknown set encoding: %i" % code)
+
+    return values, end
+
+
+def decode_lineset(buf, pos=0):
+    """
+    Decode a set written by `encode_set` from `buf` at `pos` as a LineSet.
+    """
+    if six.indexbytes(buf, pos) == BITMAP:
+        length, start = decode_varint(buf, pos + 1)
+        return LineSet.from_bytes(buf[start:start + length])
+
+    values, _ = decode_set(buf, pos)
+    return LineSet(values)
+
+
+def _encode_postings(file_tests):
+    """
+    Encode the inverted index of one file.
+
+    Parameters
+    ----------
+    file_tests : sequence of (int, list of int)
+        The id of each test which executed the file, in ascending
+        order, and the sorted lines it covered
+
+    The result is the encoded set of covered lines, a code byte, the
+    number of tests covering each line, then test id deltas for each
+    line (restarting from zero at each line).
+    """
+    tests_by_line = {}
+    for test_id, lines in file_tests:
+        for line in lines:
+            try:
+                tests_by_line[line].append(test_id)
+            except KeyError:
+                tests_by_line[line] = [test_id]
+
+    lines = sorted(tests_by_line)
+    groups = [tests_by_line[line] for line in lines]
+    deltas = []
+    for test_ids in groups:
+        deltas.append(test_ids[0])
+        deltas.extend(map(sub, test_ids[1:], test_ids))
+
+    code = DELTA_CODES[_width(max(deltas))] if deltas else 0
+    return b''.join([
+        encode_set(lines),
+        six.int2byte(code),
+        _pack_array(COUNTS, map(len, groups)),
+        _pack_array(code, deltas),
+    ])
+
+
+def _encode_strings(strings):
+    return u''.join(s + SEPARATOR for s in strings).encode('utf8')
+
+
+def _decode_strings(payload):
+    return bytes(payload).decode('utf8').split(SEPARATOR)[:-1]
+
+
+class SegmentWriter(object):
+    """
+    Incrementally write one segment of a binary report to a file.
+
+    Test contexts are written one at a time with `add`, and their
+    line data is written immediately. The string tables and directory
+    are held in memory and written by `close`. If `index` is True,
+    `close` also builds the inverted index one source file at a time,
+    by reading back the line data that was written. `fh` must then be
+    readable and seekable.
+    """
+
+    def __init__(self, fh, index=False):
+        self.fh = fh
+        self.index = index
+        self.start = fh.tell()
+        self.tests = []
+        self.files = []
+        self.file_ids = {}
+        self.contexts = []
+        self.directory = []
+        self.durations = []
+        self.pos = 0
+        self.lines_size = 0
+
+        self._write(HEADER.pack(MAGIC, VERSION))
+        self.lines_offset = self.pos
+
+    def _write(self, data):
+        self.fh.write(data)
+        self.pos += len(data)
+
+    def _file_id(self, path):
+        try:
+            return self.file_ids[path]
+        except KeyError:
+            self.file_ids[path] = len(self.files)
+            self.files.append(path)
+            return self.file_ids[path]
+
+    def add(self, test_context, cover, duration=None):
+        """
+        Write the coverage of a single test context.
+
+        Parameters
+        ----------
+        test_context : str
+        cover : dict
+            Mapping from source file path to covered line numbers.
+        duration : float (optional)
+            The time the test took to run, in seconds
+        """
+        if SEPARATOR in test_context:
+            raise ValueError("Invalid test context: %r" % test_context)
+
+        self.tests.append(test_context)
+        self.contexts.append((len(self.directory), len(cover)))
+        self.durations.append(duration)
+
+        for path in sorted(cover):
+            block = encode_lineset(LineSet.coerce(cover[path]))
+            self.directory.append((self._file_id(path), self.lines_size))
+            self._write(block)
+            self.lines_size += len(block)
+
+    def _file_entries(self):
+        """
+        Group the directory by source file.
+
+        Returns
+        -------
+        For each file, a list of (test id, start, end) offsets of its
+        blocks in the lines section, in test order.
+        """
+        # blocks are contiguous, so each ends where the next begins
+        ends = [offset for _, offset in self.directory[1:]]
+        ends.append(self.lines_size)
+
+        entries = [[] for _ in self.files]
+        for test_id, (first, count) in enumerate(self.contexts):
+            for idx in range(first, first + count):
+                file_id, offset = self.directory[idx]
+                entries[file_id].append((test_id, offset, ends[idx]))
+        return entries
+
+    def _write_index(self, entries):
+        """
+        Write the inverted index, one source file at a time.
+
+        Returns
+        -------
+        The offset of each file's postings within the index.
+        """
+        base = self.start + self.lines_offset
+        start = self.pos
+        offsets = []
+        for file_entries in entries:
+            file_tests = []
+            for test_id, offset, end in file_entries:
+                self.fh.seek(base + offset)
+                lines, _ = decode_set(self.fh.read(end - offset))
+                file_tests.append((test_id, lines))
+
+            self.fh.seek(self.start + self.pos)
+            offsets.append(POSTINGS.pack(self.pos - start))
+            self._write(_encode_postings(file_tests))
+
+        return b''.join(offsets)
+
+    def close(self):
+        sections = [(b'lines', self.lines_offset, self.lines_size)]
+
+        def section(name, payload):
+            sections.append((name, self.pos, len(payload)))
+            self._write(payload)
+
+        section(b'tests', _encode_strings(self.tests))
+        section(b'files', _encode_strings(self.files))
+        section(b'contexts', b''.join(
+            CONTEXT.pack(*context) for context in self.contexts))
+        section(b'directory', b''.join(
+            ENTRY.pack(*entry) for entry in self.directory))
+
+        entries = self._file_entries()
+        if self.index:
+            index_offset = self.pos
+            postings = self._write_index(entries)
+            sections.append(
+                (b'index', index_offset, self.pos - index_offset))
+            section(b'postings', postings)
+        if any(duration is not None for duration in self.durations):
+            section(b'durations', b''.join(
+                DURATION.pack(float('nan') if duration is None else duration)
+                for duration in self.durations))
+
+        toc_offset = self.pos
+        toc = [encode_varint(len(sections))]
+        for name, offset, length in sections:
+            toc.extend([
+                encode_varint(len(name)), name,
+                encode_varint(offset), encode_varint(length)
+            ])
+        self._write(b''.join(toc))
+        self._write(TRAILER.pack(
+            toc_offset, self.pos + TRAILER.size, MAGIC))
+
+
+class Segment(object):
+    """
+    Read-only view of one segment of a binary report.
+    """
+
+    def __init__(self, buf, start, end):
+        """
+        Parameters
+        ----------
+        buf : bytes-like
+            The report contents
+        start, end : int
+            The byte range of the segment within `buf`
+        """
+        self.buf = buf
+        self.start = start
+
+        magic, version = HEADER.unpack_from(buf, start)
+        if magic != MAGIC:
+            raise ValueError("Not a smother segment")
+        if version > VERSION:
+            raise ValueError(
+                "Unsupported smother format version %i" % version)
+
+        toc_offset, _, _ = TRAILER.unpack_from(buf, end - TRAILER.size)
+        pos = start + toc_offset
+        count, pos = decode_varint(buf, pos)
+        self.sections = {}
+        for _ in range(count):
+            length, pos = decode_varint(buf, pos)
+            name = bytes(buf[pos:pos + length])
+            offset, pos = decode_varint(buf, pos + length)
+            length, pos = decode_varint(buf, pos)
+            self.sections[name] = (start + offset, length)
+
+        self.tests = _decode_strings(self.section(b'tests'))
+        self.files = _decode_strings(self.section(b'files'))
+        self.test_ids = {test: idx for idx, test in enumerate(self.tests)}
+        self.file_ids = {path: idx for idx, path in enumerate(self.files)}
+        # {test_idx: {file_id: lines offset}}, built as tests are looked up
+        self.directories = {}
+        # {file_id: [test_idx]}, built from the directory when first needed
+        self.file_tests = None
+
+    def section(self, name):
+        offset, length = self.sections[name]
+        return self.buf[offset:offset + length]
+
+    def entries(self, test_idx):
+        """
+        Iterate over (file_id, lines offset) directory entries
+        of the `test_idx`-th test.
+        """
+        contexts, _ = self.sections[b'contexts']
+        directory, _ = self.sections[b'directory']
+        first, count = CONTEXT.unpack_from(
+            self.buf, contexts + CONTEXT.size * test_idx)
+        start = directory + ENTRY.size * first
+        return iter_unpack(ENTRY, self.buf[start:start + ENTRY.size * count])
+
+    def find(self, test_idx, path):
+        """
+        Return the lines offset of a (test, file) pair, or None.
+        """
+        file_id = self.file_ids.get(path)
+        if file_id is None:
+            return None
+        directory = self.directories.get(test_idx)
+        if directory is None:
+            directory = dict(self.entries(test_idx))
+            self.directories[test_idx] = directory
+        return directory.get(file_id)
+
+    def lines(self, offset):
+        """
+        Decode the line set stored at `offset` of the lines section.
+        """
+        lines_offset, _ = self.sections[b'lines']
+        return decode_lineset(self.buf, lines_offset + offset)
+
+    def coverage(self, test_idx):
+        """
+        Decode the {file: lines} coverage of the `test_idx`-th test.
+        """
+        return {
+            self.files[file_id]: self.lines(offset)
+            for file_id, offset in self.entries(test_idx)
+        }
+
+    def to_dict(self):
+        return {
+            test: self.coverage(idx)
+            for idx, test in enumerate(self.tests)
+        }
+
+    @property
+    def indexed(self):
+        return b'index' in self.sections
+
+    def durations(self):
+        """
+        Return the {test: seconds} durations recorded in this segment.
+        """
+        if b'durations' not in self.sections:
+            return {}
+        return {
+            test: duration
+            for test, (duration,) in zip(
+                self.tests, iter_unpack(DURATION, self.section(b'durations')))
+            if duration == duration  # skip NaN
+        }
+
+    def tests_for_file(self, path):
+        """
+        Return the tests which executed `path`.
+
+        Indexed segments read the tests from the postings of `path`.
+        Otherwise, the directory is scanned once, and the tests of
+        every file are kept for later calls.
+        """
+        file_id = self.file_ids.get(path)
+        if file_id is None:
+            return []
+
+        if self.indexed:
+            test_ids = set()
+            for _, ref in self.postings(path):
+                test_ids.update(self._test_ids_at(ref))
+            return [self.tests[test_id] for test_id in sorted(test_ids)]
+
+        if self.file_tests is None:
+            contexts = iter_unpack(CONTEXT, self.section(b'contexts'))
+            entries = [entry for entry, _ in
+                       iter_unpack(ENTRY, self.section(b'directory'))]
+            self.file_tests = {}
+            for test_idx, (first, count) in enumerate(contexts):
+                for entry in entries[first:first + count]:
+                    self.file_tests.setdefault(entry, []).append(test_idx)
+
+        return [
+            self.tests[test_idx]
+            for test_idx in self.file_tests.get(file_id, ())
+        ]
+
+    def postings(self, path):
+        """
+        Iterate over the inverted index of a file.
+
+        Yields
+        ------
+        (line, ref) pairs for each covered line in `path`.
+        `ref` locates the set of tests covering the line,
+        which can be decoded with `tests_at`.
+        """
+        file_id = self.file_ids.get(path)
+        if file_id is None:
+            return
+
+        index, _ = self.sections[b'index']
+        postings, _ = self.sections[b'postings']
+        offset, = POSTINGS.unpack_from(
+            self.buf, postings + POSTINGS.size * file_id)
+        lines, pos = decode_set(self.buf, index + offset)
+        code = six.indexbytes(self.buf, pos)
+        pos += 1
+        end = pos + WIDTHS[COUNTS] * len(lines)
+        counts = _unpack_array(COUNTS, self.buf[pos:end])
+
+        pos = end
+        for line, count in zip(lines, counts):
+            yield line, (code, pos, count)
+            pos += WIDTHS[code] * count
+
+    def _test_ids_at(self, ref):
+        code, pos, count = ref
+        payload = self.buf[pos:pos + WIDTHS[code] * count]
+        return accumulate(_unpack_array(code, payload))
+
+    def tests_at(self, ref):
+        return [self.tests[test_id] for test_id in self._test_ids_at(ref)]
+
+
+class Coverage(Mapping):
+    """
+    Lazily decoded {file: lines} coverage of one test in a `Report`.
+    """
+
+    def __init__(self, refs):
+        """
+        Parameters
+        ----------
+        refs : list of (Segment, int)
+            The segments containing the test, and its index in each.
+        """
+        self.refs = refs
+
+    def __getitem__(self, path):
+        result = None
+        for segment, test_idx in self.refs:
+            offset = segment.find(test_idx, path)
+            if offset is None:
+                continue
+            lines = segment.lines(offset)
+            if result is None:
+                result = lines
+            else:
+                result = result | lines
+
+        if result is None:
+            raise KeyError(path)
+        return result
+
+    def __iter__(self):
+        seen = set()
+        for segment, test_idx in self.refs:
+            for file_id, _ in segment.entries(test_idx):
+                path = segment.files[file_id]
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        return self._decode().items()
+
+    def values(self):
+        return self._decode().values()
+
+    def _decode(self):
+        """
+        Decode every file of the test, reading each segment's
+        directory entries once.
+        """
+        result = {}
+        for segment, test_idx in self.refs:
+            for file_id, offset in segment.entries(test_idx):
+                path = segment.files[file_id]
+                lines = segment.lines(offset)
+                if path in result:
+                    lines = result[path] | lines
+                result[path] = lines
+        return result
+
+
+class Report(Mapping):
+    """
+    Read-only, lazily decoded {test: {file: lines}} view of a binary report.
+
+    Opening a report only decodes the string tables of each segment.
+    Line sets are decoded when they are looked up, so queries only
+    touch the (test, file) blocks they need.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.segments = list(iter_segments(buf))
+        # {test: [(segment, test index)]}, so that looking up a test
+        # does not visit every segment
+        self.refs = {}
+        for segment in self.segments:
+            for idx, test in enumerate(segment.tests):
+                self.refs.setdefault(test, []).append((segment, idx))
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-map a binary report.
+
+        Raises
+        ------
+        ValueError, if `path` is empty or not a binary smother report.
+        """
+        with open(path, 'rb') as infile:
+            buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if not is_binary(buf):
+            buf.close()
+            raise ValueError("%s is not a binary smother report" % path)
+        return cls(buf)
+
+    @property
+    def indexed(self):
+        """
+        Whether every segment contains an inverted index.
+        """
+        return all(segment.indexed for segment in self.segments)
+
+    def durations(self):
+        """
+        Return the {test: seconds} durations recorded in the report.
+        """
+        return merge_durations(
+            {}, *[segment.durations() for segment in self.segments])
+
+    def tests_for_file(self, path):
+        """
+        Return the set of tests which executed any line of `path`.
+        """
+        result = set()
+        for segment in self.segments:
+            result.update(segment.tests_for_file(path))
+        return result
+
+    def tests_for_lines(self, path, predicate):
+        """
+        Use the inverted index to find tests that cover part of a file.
+
+        Parameters
+        ----------
+        path : str
+            The source file
+        predicate : callable
+            Called with each covered line number in `path`
+
+        Returns
+        -------
+        The set of tests which cover a line for which `predicate`
+        is True.
+        """
+        result = set()
+        for segment in self.segments:
+            for line, pos in segment.postings(path):
+                if predicate(line):
+                    result.update(segment.tests_at(pos))
+        return result
+
+    def close(self):
+        close = getattr(self.buf, 'close', None)
+        if close is not None:
+            close()
+
+    def __getitem__(self, test):
+        return Coverage(self.refs[test])
+
+    def __contains__(self, test):
+        return test in self.refs
+
+    def __iter__(self):
+        if len(self.segments) == 1:
+            return iter(self.segments[0].tests)
+        return iter(sorted(self.refs))
+
+    def __len__(self):
+        return len(self.refs)
+
+
+def _segment_length(buf, end):
+    """
+    Return the length of a complete segment ending at `end`, or None.
+    """
+    if end < HEADER.size + TRAILER.size:
+        return None
+    _, length, magic = TRAILER.unpack_from(buf, end - TRAILER.size)
+    if magic != MAGIC or length > end or length < HEADER.size:
+        return None
+    if bytes(buf[end - length:end - length + len(MAGIC)]) != MAGIC:
+        return None
+    return length
+
+
+def _recover_end(buf, end):
+    """
+    Find the end of the last complete segment before `end`.
+
+    A process killed while appending to a report leaves an incomplete
+    segment behind. Every trailer ends with MAGIC, so search backwards
+    for the last one which closes a complete segment.
+    """
+    pos = end
+    while True:
+        pos = buf.rfind(MAGIC, 0, pos)
+        if pos < 0:
+            raise ValueError("Corrupt smother report")
+        if _segment_length(buf, pos + len(MAGIC)) is not None:
+            return pos + len(MAGIC)
+
+
+def iter_segments(buf):
+    """
+    Yield the segments in a binary report, last segment first.
+
+    Incomplete segments, left by writers that were interrupted while
+    appending, are skipped.
+    """
+    end = len(buf)
+    while end > 0:
+        length = _segment_length(buf, end)
+        if length is None:
+            end = _recover_end(buf, end)
+            continue
+        yield Segment(buf, end - length, end)
+        end -= length
+
+
+def is_binary(buf):
+    return bytes(buf[:len(MAGIC)]) == MAGIC
+
+
+def merge_data(target, source):
+    """
+    Merge {test: {file: lines}} coverage from `source` into `target`.
+    """
+    for test, cover in source.items():
+        old_cover = target.setdefault(test, {})
+        for path, lines in cover.items():
+            old = old_cover.get(path)
+            if old is None:
+                old_cover[path] = LineSet.coerce(lines)
+            else:
+                old_cover[path] = old | lines
+    return target
+
+
+def merge_durations(target, *sources):
+    """
+    Merge {test: seconds} durations from `sources` into `target`.
+
+    A test recorded more than once keeps its longest duration.
+    """
+    for source in sources:
+        for test, duration in source.items():
+            old = target.get(test)
+            if old is None or duration > old:
+                target[test] = duration
+    return target
+
+
+def _from_json(data):
+    return {
+        test: {
+            path: LineSet(lines) for path, lines in cover.items()
+        }
+        for test, cover in data.items()
+    }
+
+
+def loads(contents):
+    """
+    Parse the contents of a smother report in any supported format.
+
+    Raises
+    ------
+    ValueError, if `contents` is not a smother report.
+    """
+    if isinstance(contents, six.text_type):
+        return _from_json(json.loads(contents))
+
+    if not is_binary(contents):
+        return _from_json(json.loads(contents.decode('utf8')))
+
+    data = {}
+    for segment in iter_segments(contents):
+        merge_data(data, segment.to_dict())
+    return data
+
+
+def loads_durations(contents):
+    """
+    Return the {test: seconds} durations stored in a report's contents.
+
+    JSON reports do not record durations.
+    """
+    if isinstance(contents, six.text_type) or not is_binary(contents):
+        return {}
+    return merge_durations(
+        {}, *[segment.durations() for segment in iter_segments(contents)])
+
+
+def merge(reports, fh, map_path=None, durations=None, select=None):
+    """
+    Stream several reports into a single, indexed binary report.
+
+    Tests are visited in sorted order with a k-way merge, so only the
+    coverage of one test is held in memory at a time. The output is
+    identical to writing the result of merging every report in memory
+    with ``dumps(..., index=True)``.
+
+    Parameters
+    ----------
+    reports : sequence of mappings
+        {test: {file: lines}} coverage, typically lazy `Report`s
+    fh : file
+        Binary file to write the merged report to (see `SegmentWriter`)
+    map_path : callable (optional)
+        Applied to every source file path before merging
+    durations : dict (optional)
+        {test: seconds} durations to store with the merged coverage
+    select : callable (optional)
+        If given, only tests for which ``select(test)`` is true are merged
+    """
+    durations = durations or {}
+    streams = [
+        zip(sorted(report if select is None else filter(select, report)),
+            repeat(idx))
+        for idx, report in enumerate(reports)
+    ]
+    writer = SegmentWriter(fh, index=True)
+
+    for test, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        cover = {}
+        for _, idx in group:
+            for path, lines in reports[idx][test].items():
+                if map_path is not None:
+                    path = map_path(path)
+                old = cover.get(path)
+                cover[path] = LineSet.coerce(lines) | (old or ())
+        writer.add(test, cover, durations.get(test))
+
+    writer.close()
+
+
+def compact(fh):
+    """
+    Rewrite a binary report as a single, indexed segment.
+
+    Parameters
+    ----------
+    fh : file
+        The report, opened for reading and (appending) writing.
+        Callers are responsible for locking it.
+
+    Returns
+    -------
+    True if the report was rewritten, False if it already was a
+    single indexed segment (or is empty, or not a binary report).
+    """
+    fh.seek(0, os.SEEK_END)
+    if not fh.tell():
+        return False
+
+    buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if not is_binary(buf):
+            return False
+        report = Report(buf)
+        if len(report.segments) < 2 and report.indexed:
+            return False
+
+        with TemporaryFile() as tmp:
+            merge([report], tmp, durations=report.durations())
+            # release the mapping before truncating the file under it
+            del report
+            buf.close()
+
+            fh.seek(0)
+            fh.truncate()
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, fh)
+        return True
+    finally:
+        buf.close()
+
+
+def _as_dict(data):
+    if isinstance(data, dict):
+        return data
+    return {test: dict(cover) for test, cover in data.items()}
+
+
+def dumps(data, format=BINARY, durations=None, index=False):
+    """
+    Serialize {test: {file: lines}} coverage data, and optionally
+    {test: seconds} durations. Durations are not stored in JSON.
+
+    If `index` is True, binary reports include the inverted index
+    of each file (see `SegmentWriter`).
+    """
+    if format == JSON:
+        return json.dumps(_as_dict(data), default=list).encode('utf8')
+    if format == SQLITE:
+        raise ValueError("SQLite reports can only be written to a path")
+    if format != BINARY:
+        raise ValueError("Unknown smother format: %s" % format)
+
+    durations = durations or {}
+    buf = BytesIO()
+    writer = SegmentWriter(buf, index=index)
+    for test in sorted(data):
+        writer.add(test, data[test], durations.get(test))
+    writer.close()
+    return buf.getvalue()
+
+
+def format_for_path(path):
+    """
+    Choose a format for a report path. JSON is used for `.json` files,
+    and SQLite for `.db` and `.sqlite` files.
+    """
+    if path.endswith('.json'):
+        return JSON
+    if path.endswith(SQLITE_EXTENSIONS):
+        return SQLITE
+    return BINARY
+
+
+def format_for_file(fh):
+    """
+    Choose a format for an open file. Text files receive JSON.
+    """
+    return JSON if isinstance(fh, TextIOBase) else BINARY
+
+
+def dump(data, fh, format=BINARY, durations=None, index=False):
+    if isinstance(fh, TextIOBase):
+        if format != JSON:
+            raise ValueError("Binary reports require a binary file")
+        json.dump(_as_dict(data), fh, default=list)
+    else:
+        fh.write(dumps(data, format, durations, index))
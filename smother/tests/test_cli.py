@@ -1,10 +1,13 @@
-import json
 from tempfile import NamedTemporaryFile
 
+import mock
 import pytest
 from click.testing import CliRunner
 
+from smother import storage
 from smother.cli import cli
+from smother.control import Smother
+from smother.tests.test_diff import MultiFileDiffReporter
 
 
 CASES = [
@@ -29,6 +32,24 @@ def test_lookup(line, expected):
     assert result.output == expected
 
 
+def test_lookup_aliases():
+    # recorded on another machine, which .parallel_coveragerc aliases
+    report = Smother()
+    report.data = {'test1': {'/test-root/smother/tests/demo.py': [8]}}
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf:
+        report.write(tf.name)
+        for options, expected in [([], '\n'),
+                                  (['--rcfile', '.parallel_coveragerc'],
+                                   'test1\n')]:
+            result = runner.invoke(
+                cli, options + ['-r', tf.name, 'lookup',
+                                'smother.tests.demo:8'])
+            assert result.exit_code == 0
+            assert result.output == expected
+
+
 def test_combine():
 
     expected = {
@@ -59,8 +80,7 @@ def test_combine():
         )
 
         assert result.exit_code == 0
-        tf.seek(0)
-        assert json.load(tf) == expected
+        assert Smother.load(tf.name).data == expected
 
 
 def test_combine_different_root():
@@ -94,8 +114,7 @@ def test_combine_different_root():
         )
 
         assert result.exit_code == 0
-        tf.seek(0)
-        assert json.load(tf) == expected
+        assert Smother.load(tf.name).data == expected
 
 
 def test_csv():
@@ -143,3 +162,158 @@ def test_semantic_csv():
         assert result.exit_code == 0
         tf.seek(0)
         assert tf.read() == expected
+
+
+@pytest.mark.parametrize('options,sources', [
+    ([], ['smother/tests/.smother', 'smother/tests/.smother_2']),
+    (['--rcfile', '.parallel_coveragerc'],
+     ['smother/tests/.smother', 'smother/tests/.smother_3']),
+])
+def test_combine_modes_match(options, sources):
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as combined, NamedTemporaryFile() as loaded, \
+            NamedTemporaryFile() as parallel:
+        for flags, dst in [(['--stream'], combined),
+                           (['--no-stream'], loaded),
+                           (['--jobs=2'], parallel)]:
+            result = runner.invoke(
+                cli,
+                options + ['combine'] + flags + sources + [dst.name]
+            )
+            assert result.exit_code == 0
+
+        with open(combined.name, 'rb') as a, open(loaded.name, 'rb') as b:
+            assert a.read() == b.read()
+
+        # each process writes one segment of the parallel report
+        with open(parallel.name, 'rb') as infile:
+            contents = infile.read()
+        assert len(list(storage.iter_segments(contents))) == 2
+        assert storage.Report(contents).indexed
+        assert (Smother.load(parallel.name).data ==
+                Smother.load(loaded.name).data)
+
+
+def test_combine_timings():
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf:
+        result = runner.invoke(
+            cli,
+            ['combine', '--jobs=2', '--timings',
+             'smother/tests/.smother', 'smother/tests/.smother_2', tf.name]
+        )
+        assert result.exit_code == 0
+        phases = [line.split()[0] for line in result.output.splitlines()]
+        assert phases == ['merge', 'concat']
+
+
+def test_lookup_reads_journal():
+    report = Smother.load('smother/tests/.smother')
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf:
+        for test in ['test1', 'test2', 'test3']:
+            part = Smother()
+            part.data = {test: report.data[test]}
+            part.write(tf.name, append=True)
+
+        with open(tf.name, 'rb') as infile:
+            journal = infile.read()
+
+        # lookups read the segments as they are, without rewriting
+        result = runner.invoke(
+            cli, ['-r', tf.name, 'lookup', 'smother.tests.demo:8-13'])
+        assert result.exit_code == 0
+        assert result.output == 'test1\ntest2\n'
+        with open(tf.name, 'rb') as infile:
+            assert infile.read() == journal
+
+        result = runner.invoke(cli, ['-r', tf.name, 'compact'])
+        assert result.exit_code == 0
+        assert not Smother.compact(tf.name)
+
+        result = runner.invoke(
+            cli, ['-r', tf.name, 'lookup', 'smother.tests.demo:8-13'])
+        assert result.output == 'test1\ntest2\n'
+
+
+def test_lookup_shard():
+    report = Smother.load('smother/tests/.smother')
+    report.durations = {'test1': 10.0, 'test2': 1.0, 'test3': 1.0}
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf:
+        report.write(tf.name)
+        outputs = [
+            runner.invoke(cli, ['-r', tf.name, 'lookup', '--shard',
+                                shard, 'smother.tests.demo']).output
+            for shard in ['1/2', '2/2']
+        ]
+        assert outputs == ['test1\n', 'test2\ntest3\n']
+
+        result = runner.invoke(
+            cli, ['-r', tf.name, 'lookup', '--shard', '3/2', 'smother'])
+        assert result.exit_code != 0
+
+
+def test_diff_budget():
+    path = 'smother/tests/demo.py'
+    old = open(path).read()
+    new = old.replace('    pass', '    return 1')
+    diff = MultiFileDiffReporter({path: (old, new)})
+    diff.close = mock.Mock()
+
+    report = Smother()
+    report.data = {
+        'test_foo': {path: [8]},
+        'test_bar': {path: [12]},
+        'test_both': {path: [8, 12]},
+    }
+    report.durations = {'test_foo': 1.0, 'test_bar': 1.0, 'test_both': 5.0}
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf, \
+            mock.patch('smother.cli.GitDiffReporter', return_value=diff):
+        report.write(tf.name)
+        result = runner.invoke(
+            cli, ['-r', tf.name, 'diff', '--budget', '2'])
+        assert result.exit_code == 0
+        assert result.output.splitlines() == [
+            'covered 2 of 2 changed regions (100.0%) in 2.0s of 2.0s',
+            'test_bar',
+            'test_foo',
+        ]
+
+        result = runner.invoke(
+            cli, ['-r', tf.name, 'diff', '--budget', '1.5'])
+        assert result.output.splitlines()[0].startswith('covered 1 of 2')
+
+
+@pytest.mark.parametrize('semantic,summary,expected', [
+    ([], '3 of 4 tests cover all 4 lines',
+     ['test_bar', 'test_foo', 'test_module']),
+    (['--semantic'], '2 of 4 tests cover all 3 contexts',
+     ['test_both', 'test_module']),
+])
+def test_minimize(semantic, summary, expected):
+    path = 'smother/tests/demo.py'
+    report = Smother()
+    report.data = {
+        '': {path: [1, 2, 3]},
+        'test_module': {path: [3]},
+        'test_foo': {path: [8]},
+        'test_bar': {path: [11, 12]},
+        'test_both': {path: [8, 11]},
+    }
+    # test_both covers as many lines as test_bar, but is slower. It
+    # covers more contexts than any other test, though.
+    report.durations = {'test_foo': 1.0, 'test_bar': 1.0, 'test_both': 9.0}
+    runner = CliRunner()
+
+    with NamedTemporaryFile() as tf:
+        report.write(tf.name)
+        result = runner.invoke(cli, ['-r', tf.name] + semantic + ['minimize'])
+        assert result.exit_code == 0
+        assert result.output.splitlines() == [summary] + expected
@@ -1,11 +1,18 @@
 import json
 import mock
+import multiprocessing
 import os
 
+import pytest
 from coverage.control import Coverage
+from portalocker import Lock
+from portalocker import LockException
 
+from smother import storage
+from smother.control import BackgroundWriter
 from smother.control import get_smother_filename  # nopep8
 from smother.control import Smother
+from smother.interval import LineInterval
 from smother.tests.utils import tempdir
 
 
@@ -38,6 +45,136 @@ def test_append():
         assert Smother.load(outpath).data == combine
 
 
+def _segment_count(path):
+    with open(path, 'rb') as infile:
+        return len(list(storage.iter_segments(infile.read())))
+
+
+def test_append_journal():
+    a = {'test1': {'a': [1]}}
+    b = {'test1': {'a': [2]}, 'test2': {'a': [3]}}
+    combine = {'test1': {'a': [1, 2]}, 'test2': {'a': [3]}}
+
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+
+        for data in [a, b]:
+            smother = Smother()
+            smother.data = data
+            smother.write(outpath, append=True)
+
+        # the second write appends a segment without reading the first
+        with open(outpath, 'rb') as infile:
+            assert infile.read().endswith(storage.dumps(b))
+        assert _segment_count(outpath) == 2
+        assert Smother.load(outpath).data == combine
+
+        # another process is writing to the report
+        with Lock(outpath, mode='a+b', fail_when_locked=True):
+            assert not Smother.try_compact(outpath)
+        assert _segment_count(outpath) == 2
+
+        assert Smother.compact(outpath)
+        assert not Smother.compact(outpath)
+        assert _segment_count(outpath) == 1
+        assert Smother.load(outpath).data == combine
+
+
+def test_append_to_json():
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+        with open(outpath, 'w') as outfile:
+            json.dump({'test1': {'a': [1]}}, outfile)
+
+        smother = Smother()
+        smother.data = {'test2': {'a': [2]}}
+        smother.write(outpath, append=True)
+
+        assert _segment_count(outpath) == 1
+        assert Smother.load(outpath).data == {
+            'test1': {'a': [1]},
+            'test2': {'a': [2]},
+        }
+
+
+def _append_worker(args):
+    outpath, idx = args
+    smother = Smother()
+    smother.data = {'test%i' % idx: {'a': [idx]}}
+    smother.write(outpath, append=True)
+
+
+def test_concurrent_append():
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(_append_worker, [(outpath, i) for i in range(1, 21)])
+        finally:
+            pool.close()
+            pool.join()
+
+        assert Smother.load(outpath).data == {
+            'test%i' % i: {'a': [i]} for i in range(1, 21)
+        }
+
+
+def test_stream():
+    cov = mock.MagicMock()
+    cov.config.parallel = False
+
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+        with open(outpath, 'wb') as outfile:
+            outfile.write(storage.dumps({'stale': {'a': [1]}}))
+
+        smother = Smother(cov)
+        assert smother.stream(outpath) == outpath
+        for idx in range(1, 4):
+            cov.collector.data = {'a': {idx: None}}
+            smother.save_context('test%i' % idx)
+        smother.close_stream()
+
+        assert smother.data == {}
+        assert Smother.load(outpath).data == {
+            'test%i' % i: {'a': [i]} for i in range(1, 4)
+        }
+        assert _segment_count(outpath) == 1
+
+
+def test_stream_skips_locked_compaction():
+    cov = mock.MagicMock()
+    cov.config.parallel = False
+
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+        with open(outpath, 'wb') as outfile:
+            outfile.write(storage.dumps({'test1': {'a': [1]}}))
+
+        smother = Smother(cov)
+        smother.stream(outpath, append=True)
+        cov.collector.data = {'a': {2: None}}
+        smother.save_context('test2')
+
+        # another process is writing to the report
+        with mock.patch.object(Smother, 'compact',
+                               side_effect=LockException):
+            smother.close_stream()
+
+        assert _segment_count(outpath) == 2
+        assert Smother.load(outpath).data == {
+            'test1': {'a': [1]}, 'test2': {'a': [2]}}
+
+
+def test_stream_error():
+    with tempdir() as base:
+        # the report path is a directory, so writing fails
+        writer = BackgroundWriter(base)
+        writer.put('test1', {'a': [1]})
+        with pytest.raises(EnvironmentError):
+            writer.close()
+
+
 def test_write_coverage():
 
     a = {
@@ -105,3 +242,154 @@ def test_convert_to_relative_paths():
     }
 
     assert Smother.convert_to_relative_paths(smother).data == expected_data
+
+
+class FakeFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def test_query_context_aliases():
+    cov = mock.MagicMock()
+    cov.config.paths = {'source': ['/src/', '/build/']}
+    smother = Smother(cov)
+    smother.data = {
+        'test1': {'/src/pkg/a.py': [1, 2]},
+        'test2': {'/src/pkg/a.py': [10], '/src/pkg/b.py': [1]},
+        'test3': {'/src/pkg/b.py': [2]},
+    }
+
+    regions = [
+        LineInterval('/build/pkg/a.py', 1, 3),
+        LineInterval('/build/pkg/b.py', 2, 3),
+        LineInterval('/build/pkg/a.py', 20, 21),
+    ]
+    result = smother.query_context(regions, file_factory=FakeFile)
+    assert result.contexts == {'test1', 'test3'}
+
+
+def test_tests_for_file():
+    cov = mock.MagicMock()
+    smother = Smother(cov)
+    smother.data = {'test1': {'a': [1]}, 'test2': {'a': [2], 'b': [1]}}
+    assert smother.tests_for_file('a') == {'test1', 'test2'}
+    assert smother.tests_for_file('c') == set()
+
+    cov.collector.data = {'c': {3: None}}
+    smother.save_context('test3')
+    other = Smother()
+    other.data = {'test4': {'b': [1]}}
+    smother |= other
+    assert smother.tests_for_file('c') == {'test3'}
+    assert smother.tests_for_file('b') == {'test2', 'test4'}
+
+    smother.data['test1'] = {'b': [1]}
+    assert smother.tests_for_file('a') == {'test2'}
+
+
+def test_save_context_drains_collector():
+    cov = mock.MagicMock()
+    smother = Smother(cov)
+
+    # tracers keep writing to the same per-file dicts across contexts
+    a, b = {1: None, 2: None}, {}
+    cov.collector.data = {'a': a, 'b': b}
+    smother.save_context('test1')
+    assert a == {} and b == {}
+    assert cov.collector.data == {'a': a, 'b': b}
+    assert cov.collector.data['a'] is a
+
+    b[5] = None
+    smother.save_context('test2')
+    smother.save_context('test3')
+
+    assert smother.data == {
+        'test1': {'a': [1, 2]},
+        'test2': {'b': [5]},
+        'test3': {},
+    }
+
+
+def test_query_context_after_mutation():
+    smother = Smother()
+    smother.data = {'test1': {os.path.abspath('a.py'): [1, 2]}}
+    region = LineInterval('a.py', 1, 5)
+    assert smother.query_context(
+        [region], file_factory=FakeFile).contexts == {'test1'}
+
+    smother.data['test2'] = {os.path.abspath('a.py'): [3]}
+    assert smother.query_context(
+        [region], file_factory=FakeFile).contexts == {'test1', 'test2'}
+
+    smother.data['test1'] = {os.path.abspath('b.py'): [1]}
+    assert smother.query_context(
+        [region], file_factory=FakeFile).contexts == {'test2'}
+    assert smother.query_context(
+        [LineInterval('b.py', 1, 5)],
+        file_factory=FakeFile).contexts == {'test1'}
+
+
+@pytest.mark.parametrize('name', ['.smother', 'report.json', 'report.db'])
+def test_durations_roundtrip(name):
+    smother = Smother()
+    smother.data = {'test1': {'a': [1]}, 'test2': {'a': [2]}}
+    smother.durations = {'test1': 0.25, 'test2': 4.0}
+    expected = {} if name.endswith('.json') else smother.durations
+
+    with tempdir() as base:
+        path = os.path.join(base, name)
+        smother.write(path)
+        assert Smother.load(path).durations == expected
+        assert Smother.load(path, lazy=True).durations == expected
+
+        combined = os.path.join(base, 'combined')
+        Smother().combine([path], combined)
+        assert Smother.load(combined).durations == expected
+
+
+def test_stream_durations():
+    cov = mock.MagicMock()
+    cov.config.parallel = False
+
+    with tempdir() as base:
+        outpath = os.path.join(base, '.smother')
+        smother = Smother(cov)
+        smother.stream(outpath)
+        for idx in range(1, 4):
+            cov.collector.data = {'a': {idx: None}}
+            smother.save_context('test%i' % idx, duration=idx / 2.0)
+        smother.close_stream()
+
+        assert Smother.load(outpath).durations == {
+            'test1': 0.5, 'test2': 1.0, 'test3': 1.5}
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_region_coverage(lazy):
+    smother = Smother()
+    smother.data = {
+        'test1': {'/src/a.py': [1, 2]},
+        'test2': {'/src/a.py': [10], '/src/b.py': [1]},
+        'test3': {'/src/b.py': [2]},
+    }
+    regions = [
+        LineInterval('/src/a.py', 1, 11),
+        LineInterval('/src/b.py', 2, 3),
+        LineInterval('/src/a.py', 20, 21),
+        LineInterval('/src/a.py', 1, 11),
+    ]
+
+    with tempdir() as base:
+        path = os.path.join(base, '.smother')
+        smother.write(path)
+        if lazy:
+            smother = Smother.load(path, lazy=True)
+
+        result = smother.region_coverage(regions, file_factory=FakeFile)
+        assert list(result.items()) == [
+            (regions[0], {'test1', 'test2'}),
+            (regions[1], {'test3'}),
+            (regions[2], set()),
+        ]
+        assert (set().union(*result.values()) ==
+                smother.query_context(regions, file_factory=FakeFile).contexts)
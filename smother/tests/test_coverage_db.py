@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import sqlite3
+
+import pytest
+
+from smother import coverage_db
+from smother import storage
+from smother.control import Smother
+from smother.coverage_db import CoverageDB
+from smother.interval import parse_intervals
+from smother.lineset import LineSet
+from smother.tests.utils import tempdir
+
+SCHEMA = """
+create table meta (key text, value text, unique (key));
+create table file (id integer primary key, path text, unique (path));
+create table context (id integer primary key, context text,
+                      unique (context));
+create table line_bits (file_id integer, context_id integer,
+                        numbits blob, unique (file_id, context_id));
+"""
+
+
+def write_coverage_db(path, data, has_arcs=False):
+    """
+    Write {test: {file: lines}} in coverage.py's SQLite schema.
+    """
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.execute("insert into meta values ('has_arcs', ?)",
+               (str(int(has_arcs)),))
+
+    files = sorted({src for cover in data.values() for src in cover})
+    file_ids = {src: idx for idx, src in enumerate(files, 1)}
+    db.executemany("insert into file values (?, ?)",
+                   [(idx, src) for src, idx in file_ids.items()])
+
+    for context_id, (test, cover) in enumerate(sorted(data.items()), 1):
+        db.execute("insert into context values (?, ?)", (context_id, test))
+        db.executemany("insert into line_bits values (?, ?, ?)", [
+            (file_ids[src], context_id, LineSet(lines).to_bytes())
+            for src, lines in cover.items()
+        ])
+
+    db.commit()
+    db.close()
+
+
+def test_load_coverage_db():
+    data = {
+        '': {'a.py': [1, 2]},
+        'test1': {'a.py': [3], 'b.py': [8, 9, 300]},
+    }
+    with tempdir() as base:
+        path = os.path.join(base, '.coverage')
+        write_coverage_db(path, data)
+
+        assert Smother.load(path).data == data
+
+        report = Smother.load(path, lazy=True).data
+        try:
+            assert isinstance(report, CoverageDB)
+            assert sorted(report) == ['', 'test1']
+            assert 'test1' in report
+            assert 'test2' not in report
+            with pytest.raises(KeyError):
+                report['test2']
+            assert report.tests_for_lines(
+                'b.py', lambda line: line > 100) == {'test1'}
+            assert report.tests_for_file('a.py') == {'', 'test1'}
+        finally:
+            report.close()
+
+
+def test_reject_branch_data():
+    with tempdir() as base:
+        path = os.path.join(base, '.coverage')
+        write_coverage_db(path, {}, has_arcs=True)
+        with pytest.raises(ValueError):
+            CoverageDB.open(path)
+
+
+@pytest.mark.parametrize('path', [
+    'smother.tests.demo',
+    'smother.tests.demo:8',
+    'smother.tests.demo:bar',
+])
+@pytest.mark.parametrize('semantic', [False, True])
+def test_queries_match(path, semantic):
+    expected = Smother.load('smother/tests/.smother')
+
+    with tempdir() as base:
+        report = os.path.join(base, '.coverage')
+        write_coverage_db(report, expected.data)
+        smother = Smother.load(report, lazy=True)
+
+        assert smother._indexed()
+        regions = parse_intervals(path, as_context=semantic)
+        assert (smother.query_context(regions).contexts ==
+                expected.query_context(regions).contexts)
+        smother.data.close()
+
+
+def test_write_sqlite():
+    data = {
+        '': {'a.py': [1, 2]},
+        'test1': {'a.py': [3], 'b.py': LineSet([8, 9, 300])},
+        'test2': {},
+    }
+    smother = Smother()
+    smother.data = data
+
+    with tempdir() as base:
+        path = os.path.join(base, 'report.db')
+        smother.write(path)
+        smother.write(path)
+        assert Smother.load(path).data == data
+
+        # the format can also be chosen explicitly
+        other = os.path.join(base, '.smother')
+        smother.write(other, format=storage.SQLITE)
+        assert Smother.load(other).data == data
+
+
+def test_append_sqlite():
+    a = {'test1': {'a': [1]}}
+    b = {'test1': {'a': [2], 'b': [1]}, 'test2': {'a': [3]}}
+
+    with tempdir() as base:
+        path = os.path.join(base, 'report.sqlite')
+        for data in [a, b]:
+            smother = Smother()
+            smother.data = data
+            smother.write(path, append=True)
+
+        assert Smother.load(path).data == {
+            'test1': {'a': [1, 2], 'b': [1]},
+            'test2': {'a': [3]},
+        }
+
+
+def test_append_sqlite_many_files():
+    # more files than fit in one lookup statement
+    a = {'test1': {'f%i.py' % i: [1] for i in range(1200)}}
+    b = {'test2': {'f%i.py' % i: [2] for i in range(0, 1200, 3)}}
+
+    with tempdir() as base:
+        path = os.path.join(base, 'report.db')
+        for data in [a, b]:
+            smother = Smother()
+            smother.data = data
+            smother.write(path, append=True)
+
+        assert Smother.load(path).data == {
+            'test1': a['test1'], 'test2': b['test2']}
+
+
+def test_wal_retries_locked():
+    class Connection(object):
+        calls = 0
+
+        def execute(self, statement):
+            self.calls += 1
+            if self.calls < 3:
+                raise sqlite3.OperationalError('database is locked')
+
+    connection = Connection()
+    coverage_db._set_wal(connection, timeout=10)
+    assert connection.calls == 3
+
+    connection = Connection()
+    with pytest.raises(sqlite3.OperationalError):
+        coverage_db._set_wal(connection, timeout=0)
+
+
+def _append_worker(args):
+    path, idx = args
+    smother = Smother()
+    smother.data = {'test%i' % idx: {'a': [idx]}}
+    smother.write(path, append=True)
+
+
+def test_concurrent_append_sqlite():
+    with tempdir() as base:
+        path = os.path.join(base, 'report.db')
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(_append_worker, [(path, i) for i in range(1, 21)])
+        finally:
+            pool.close()
+            pool.join()
+
+        assert Smother.load(path).data == {
+            'test%i' % i: {'a': [i]} for i in range(1, 21)
+        }
+
+
+def test_sqlite_durations():
+    with tempdir() as base:
+        path = os.path.join(base, 'report.db')
+        smother = Smother()
+        smother.data = {'test1': {'a': [1]}, 'test2': {'a': [2]}}
+        smother.durations = {'test1': 1.5}
+        smother.write(path)
+
+        smother.data = {'test1': {'a': [3]}, 'test2': {}}
+        smother.durations = {'test1': 0.5, 'test2': 2.0}
+        smother.write(path, append=True)
+
+        for lazy in [False, True]:
+            assert Smother.load(path, lazy=lazy).durations == {
+                'test1': 1.5, 'test2': 2.0}
+
+    # coverage.py data files have no durations
+    with tempdir() as base:
+        path = os.path.join(base, '.coverage')
+        write_coverage_db(path, {'test1': {'a': [1]}})
+        assert Smother.load(path).durations == {}
@@ -87,3 +87,35 @@ IDS = ['deletion', 'inner_addition', 'outer_addition', 'modification']
 def test_parse(new, expected):
     diff = TestDiffReporter(old, new)
     assert list(diff.changed_intervals()) == expected
+
+
+class MultiFileDiffReporter(DiffReporter):
+
+    def __init__(self, files):
+        self.files = files
+
+    @property
+    def patch_set(self):
+        diff = []
+        for path, (old, new) in sorted(self.files.items()):
+            diff.extend(unified_diff(
+                old.splitlines(), new.splitlines(),
+                fromfile=path, tofile=path, lineterm=''))
+        return PatchSet(diff)
+
+    def old_file(self, path):
+        return PythonFile(path, source=self.files[path][0])
+
+    def new_file(self, path):
+        return PythonFile(path, source=self.files[path][1])
+
+
+def test_parse_multiple_files():
+    files = {
+        'mod%i.py' % idx: (old, new)
+        for idx, (new, _) in enumerate(CASES * 3)
+    }
+    diff = MultiFileDiffReporter(files)
+
+    regions = list(diff.changed_intervals())
+    assert [region.filename for region in regions] == sorted(files)
@@ -5,6 +5,9 @@ from mock import patch
 from unidiff import PatchSet
 
 from smother import git
+from smother.python import CACHE
+from smother.python import InvalidPythonFile
+from smother.tests.utils import tempdir
 
 
 def test_execute():
@@ -83,3 +86,107 @@ class TestGitDiffReporter(object):
     def test_patch_set(self):
         reporter = git.GitDiffReporter('07ac1490a')
         assert isinstance(reporter.patch_set, PatchSet)
+
+
+@pytest.mark.integration
+def test_cat_file():
+    cat_file = git.CatFile()
+    try:
+        for path in ['setup.py', 'smother/__init__.py', 'setup.py']:
+            assert cat_file.show('HEAD', path) == git.git_show('HEAD', path)
+
+        with pytest.raises(CalledProcessError):
+            cat_file.show('HEAD', 'does_not_exist')
+
+        # the process is still usable after a missing file
+        assert cat_file.show('HEAD', 'setup.py')
+    finally:
+        cat_file.close()
+
+
+def _fake_blob(ref, path):
+    return 'sha-of-' + path
+
+
+def test_reporter_memoizes_files():
+    reporter = git.GitDiffReporter('HEAD', diff='skip')
+    with patch.object(reporter._cat_file, 'show') as show, \
+            patch.object(reporter._cat_file, 'blob', _fake_blob):
+        show.return_value = 'def foo():\n    pass\n'
+        first = reporter.old_file('a/foo.py')
+        assert reporter.old_file('foo.py') is first
+        show.assert_called_once_with('HEAD', 'foo.py')
+
+        show.return_value = 'def'
+        for _ in range(2):
+            with pytest.raises(InvalidPythonFile):
+                reporter.old_file('a/bad.py')
+        assert show.call_count == 2
+
+    path = 'smother/tests/demo.py'
+    assert reporter.new_file('b/' + path) is reporter.new_file(path)
+
+
+def test_reporter_caches_blobs():
+    CACHE.clear()
+    source = 'def foo():\n    pass\n'
+    for calls in [1, 0]:
+        reporter = git.GitDiffReporter('HEAD', diff='skip')
+        with patch.object(reporter._cat_file, 'show') as show, \
+                patch.object(reporter._cat_file, 'blob', _fake_blob):
+            show.return_value = source
+            pf = reporter.old_file('a/foo.py')
+            assert pf.context(2) == 'foo:foo'
+
+            # the second reporter finds the table by blob SHA
+            assert show.call_count == calls
+            assert pf.source == source
+
+    assert CACHE.stats == {'hits': 1, 'disk_hits': 0, 'misses': 1}
+
+
+@pytest.mark.integration
+def test_cat_file_blob():
+    cat_file = git.CatFile()
+    try:
+        sha = git.execute(['git', 'rev-parse', 'HEAD:setup.py']).strip()
+        assert cat_file.blob('HEAD', 'setup.py') == sha
+        assert cat_file.show('HEAD', 'setup.py')
+
+        with pytest.raises(CalledProcessError):
+            cat_file.blob('HEAD', 'does_not_exist')
+    finally:
+        cat_file.close()
+
+
+@pytest.mark.integration
+def test_changed_intervals_parallel(monkeypatch):
+    old = 'def foo():\n    pass\n\n\ndef bar():\n    pass\n'
+    new = 'def foo():\n    return 1\n\n\ndef bar():\n    pass\n'
+
+    with tempdir() as base:
+        monkeypatch.chdir(base)
+        git.execute(['git', 'init', '-q'])
+        for idx in range(4):
+            with open('mod%i.py' % idx, 'w') as outfile:
+                outfile.write(old)
+        git.execute(['git', 'add', '.'])
+        git.execute(['git', '-c', 'user.name=test', '-c',
+                     'user.email=test@example.com', 'commit', '-qm', 'old'])
+        for idx in range(4):
+            with open('mod%i.py' % idx, 'w') as outfile:
+                outfile.write(new)
+
+        reporter = git.GitDiffReporter('HEAD')
+        try:
+            serial = list(reporter.changed_intervals())
+            CACHE.clear()
+            assert list(reporter.changed_intervals(jobs=2)) == serial
+        finally:
+            reporter.close()
+
+    assert [tuple(region) for region in serial] == [
+        ('mod%i.py' % idx, 'mod%i:foo' % idx) for idx in range(4)]
+    # the workers' context tables are kept by the parent
+    assert CACHE.stats['misses'] == 0
+    assert len(CACHE.entries) == 8
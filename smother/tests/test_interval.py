@@ -1,6 +1,9 @@
 from smother.interval import ContextInterval
 from smother.interval import LineInterval
+from smother.interval import LineMask
 from smother.interval import parse_intervals
+from smother.lineset import LineSet
+from smother.python import PythonFile
 
 
 path = 'smother/tests/demo.py'
@@ -51,3 +54,24 @@ def test_init_module():
     assert parse_intervals('smother:1', as_context=True) == [
         ContextInterval('smother/__init__.py', 'smother')
     ]
+
+
+def test_line_mask():
+    mask = LineMask([2, 3]) | LineMask([7], tail=10)
+    assert 3 in mask and 12 in mask
+    assert 4 not in mask
+    assert mask.intersects([1, 7])
+    assert mask.intersects(LineSet([20]))
+    assert not mask.intersects([1, 4, 9])
+    assert not LineMask().intersects([1])
+
+
+def test_context_masks_match_lines():
+    pf = PythonFile(path)
+    lines = range(pf.line_count + 5)
+    for context in set(pf.lines):
+        region = ContextInterval(path, context)
+        assert [line for line in lines if line in region.mask(pf)] == [
+            line for line in lines
+            if line > 0 and pf.context(line) == context
+        ]
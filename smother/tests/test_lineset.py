@@ -0,0 +1,68 @@
+import pickle
+
+import pytest
+
+from smother.lineset import LineSet
+
+
+def test_iteration():
+    lines = LineSet([5, 1, 3, 1])
+    assert list(lines) == [1, 3, 5]
+    assert len(lines) == 3
+    assert 3 in lines
+    assert 4 not in lines
+    assert -1 not in lines
+
+
+def test_empty():
+    assert not LineSet()
+    assert list(LineSet()) == []
+    assert len(LineSet([])) == 0
+    assert LineSet([0])
+
+
+def test_equality():
+    assert LineSet([1, 2]) == LineSet([2, 1])
+    assert LineSet([1, 2]) == [1, 2]
+    assert [1, 2] == LineSet([1, 2])
+    assert LineSet([1, 2]) != [1]
+    assert LineSet([1]) != 'abc'
+    assert {'a': LineSet([3])} == {'a': [3]}
+    assert hash(LineSet([1, 2])) == hash(LineSet([2, 1]))
+
+
+def test_set_operations():
+    a = LineSet([1, 2, 3])
+    b = LineSet([3, 4])
+    assert a | b == [1, 2, 3, 4]
+    assert a & b == [3]
+    assert a - b == [1, 2]
+    assert a | [10] == [1, 2, 3, 10]
+    assert [10] | a == [1, 2, 3, 10]
+    assert a.intersects(b)
+    assert not a.intersects([4, 5])
+
+
+@pytest.mark.parametrize('start,stop,expected', [
+    (3, 6, [3, 4, 5]),
+    (3, 4, [3]),
+    (3, 3, []),
+    (5, 1, []),
+])
+def test_from_range(start, stop, expected):
+    assert LineSet.from_range(start, stop) == expected
+
+
+def test_bytes_roundtrip():
+    lines = LineSet([0, 7, 8, 1000])
+    assert LineSet.from_bytes(lines.to_bytes()) == lines
+    assert LineSet().to_bytes() == b''
+
+
+def test_pickle():
+    lines = LineSet([1, 50, 400])
+    assert pickle.loads(pickle.dumps(lines)) == lines
+
+
+def test_repr():
+    assert repr(LineSet([2, 1])) == 'LineSet([1, 2])'
@@ -1,10 +1,19 @@
-import json
 import os
 import platform
 from subprocess import check_call
 from tempfile import NamedTemporaryFile
 
+import pytest
+from coverage import Coverage
+from mock import Mock
+from mock import patch
+
+from smother.control import Smother
+from smother.pytest_plugin import pytest_configure
+from smother.pytest_plugin import Selector
 from smother.tests import demo
+from smother.tests.test_diff import MultiFileDiffReporter
+from smother.tests.utils import tempdir
 
 expected_nose = {
     "": {demo.__file__: [4, 7, 11]},
@@ -19,6 +28,12 @@ expected_pytest = {
 }
 
 
+try:
+    import xdist
+except ImportError:
+    xdist = None
+
+
 if platform.python_implementation() == 'PyPy':
     # CPython marks the last of a multiline string. PyPy marks the first.
     expected_nose[""][demo.__file__] = [1, 7, 11]
@@ -37,9 +52,7 @@ def test_nose_collection():
             stdout=devnull,
             stderr=devnull)
 
-        report.seek(0)
-        contents = report.read().decode('utf8')
-        assert json.loads(contents) == expected_nose
+        assert Smother.load(report.name).data == expected_nose
 
 
 def test_pytest_collection():
@@ -54,6 +67,157 @@ def test_pytest_collection():
             stdout=devnull,
             stderr=devnull)
 
-        report.seek(0)
-        contents = report.read().decode('utf8')
-        assert json.loads(contents) == expected_pytest
+        assert Smother.load(report.name).data == expected_pytest
+
+
+@pytest.mark.skipif(not hasattr(Coverage, 'switch_context'),
+                    reason='dynamic contexts require coverage 5')
+def test_pytest_contexts():
+    with NamedTemporaryFile() as report, open(os.devnull, 'w') as devnull:
+        check_call(
+            ['py.test',
+             'smother/tests/demo_testsuite.py',
+             '--smother-contexts',
+             '--smother=smother.tests.demo',
+             '--smother-output={}'.format(report.name)
+             ],
+            stdout=devnull,
+            stderr=devnull)
+
+        assert Smother.load(report.name).data == expected_pytest
+
+
+FIXTURE_SUITE = """
+import pytest
+
+from smother.tests import demo
+
+
+@pytest.fixture
+def tidy(request):
+    request.addfinalizer(demo.foo)
+
+
+def test_bar(tidy):
+    demo.bar()
+"""
+
+
+@pytest.mark.skipif(not hasattr(Coverage, 'switch_context'),
+                    reason='dynamic contexts require coverage 5')
+def test_pytest_contexts_teardown():
+    with tempdir() as base, open(os.devnull, 'w') as devnull:
+        with open(os.path.join(base, 'test_fixture.py'), 'w') as outfile:
+            outfile.write(FIXTURE_SUITE)
+        report = os.path.join(base, '.smother')
+        check_call(
+            ['py.test',
+             'test_fixture.py',
+             '--smother-contexts',
+             '--smother=smother.tests.demo',
+             '--smother-output={}'.format(report)
+             ],
+            cwd=base,
+            stdout=devnull,
+            stderr=devnull)
+
+        # fixture finalizers run outside of the test's context
+        data = Smother.load(report).data
+        assert data['test_fixture.py::test_bar'] == {demo.__file__: [12]}
+        assert 8 in data[''][demo.__file__]
+
+
+@pytest.mark.skipif(xdist is None, reason='requires pytest-xdist')
+def test_pytest_xdist():
+    with NamedTemporaryFile() as report, open(os.devnull, 'w') as devnull:
+        check_call(
+            ['py.test',
+             'smother/tests/demo_testsuite.py',
+             '-n', '2',
+             '--smother=smother.tests.demo',
+             '--smother-output={}'.format(report.name)
+             ],
+            stdout=devnull,
+            stderr=devnull)
+
+        assert Smother.load(report.name).data == expected_pytest
+        # worker shards are merged and removed
+        assert not [
+            path for path in os.listdir(os.path.dirname(report.name))
+            if path.startswith(os.path.basename(report.name) + '.')
+        ]
+
+
+class FakeItem(object):
+
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+        self.fspath = nodeid.split('::')[0]
+
+
+def test_pytest_select():
+    old = open(demo.__file__).read()
+    new = old.replace("def bar():\n    pass", "def bar():\n    return 1")
+    path = os.path.relpath(demo.__file__)
+    diff = MultiFileDiffReporter({
+        path: (old, new),
+        'smother/tests/test_new.py': ('', 'def test_new():\n    pass\n'),
+    })
+    diff.close = Mock()
+
+    report = Smother()
+    report.data = {
+        'suite.py::test_bar': {demo.__file__: [12]},
+        'suite.py::test_foo': {demo.__file__: [8]},
+        'smother/tests/test_new.py::test_old': {},
+    }
+    items = [FakeItem(nodeid) for nodeid in [
+        'suite.py::test_bar',
+        'suite.py::test_foo',
+        'suite.py::test_unrecorded',
+        'smother/tests/test_new.py::test_old',
+    ]]
+    config = Mock()
+
+    with tempdir() as base:
+        options = Mock(smother_select='master',
+                       smother_output=os.path.join(base, '.smother'))
+        report.write(options.smother_output)
+        with patch('smother.git.GitDiffReporter', return_value=diff):
+            Selector(options).pytest_collection_modifyitems(config, items)
+
+    assert [item.nodeid for item in items] == [
+        'suite.py::test_bar',
+        'suite.py::test_unrecorded',
+        'smother/tests/test_new.py::test_old',
+    ]
+    deselected = config.hook.pytest_deselected.call_args[1]['items']
+    assert [item.nodeid for item in deselected] == ['suite.py::test_foo']
+    diff.close.assert_called_once_with()
+
+
+def test_pytest_select_appends():
+    config = Mock()
+    config.option = Mock(smother_select='master', smother_source=['pkg'],
+                         smother_append=False)
+    config.getvalue.side_effect = lambda name: getattr(config.option, name)
+    config.getoption.return_value = 'no'
+    config.pluginmanager.hasplugin.return_value = False
+    config.workerinput = config.slaveinput = None
+
+    with patch('smother.pytest_plugin.Plugin') as plugin:
+        pytest_configure(config)
+
+    # writing the report must not drop the deselected tests' coverage
+    assert plugin.call_args[0][0].smother_append
+
+
+def test_pytest_select_missing_report():
+    with tempdir() as base:
+        options = Mock(smother_select='master',
+                       smother_output=os.path.join(base, '.smother'))
+        with pytest.raises(pytest.UsageError) as exc:
+            Selector(options).pytest_collection_modifyitems(
+                Mock(), [FakeItem('suite.py::test_bar')])
+
+    assert '.smother does not exist' in str(exc.value)
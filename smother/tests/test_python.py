@@ -3,8 +3,12 @@ from ast import parse
 
 import pytest
 
+from smother.python import CACHE
+from smother.python import ContextCache
+from smother.python import InvalidPythonFile
 from smother.python import PythonFile
 from smother.python import Visitor
+from smother.tests.utils import tempdir
 
 
 case_func = """
@@ -109,3 +113,66 @@ def test_default_prefix():
 def test_prefix_for_absolute_paths():
     path = os.path.abspath('smother/tests/demo.py')
     assert PythonFile(path).prefix == 'smother.tests.demo'
+
+
+def test_context_cache():
+    CACHE.clear()
+    first = PythonFile('test.py', prefix='', source=case_class)
+    second = PythonFile('other.py', prefix='', source=case_class)
+    assert first.lines == second.lines
+    assert CACHE.stats == {'hits': 1, 'disk_hits': 0, 'misses': 1}
+
+    # the prefix is part of each context, so it is part of the key
+    PythonFile('test.py', prefix='x', source=case_class)
+    assert CACHE.misses == 2
+
+    with pytest.raises(InvalidPythonFile):
+        PythonFile('test.py', source='def')
+
+
+def test_context_cache_on_disk():
+    runs = [('', 1), ('A', 2), ('A.method', 2), ('A', 2)]
+
+    with tempdir() as base:
+        directory = os.path.join(base, 'cache')
+        cache = ContextCache(directory=directory)
+        key = cache.key(case_class, '')
+        assert cache.get(key) is None
+        cache.put(key, runs)
+
+        cache = ContextCache(maxsize=1, directory=directory)
+        assert cache.get(key) == runs
+        assert cache.get(key) == runs
+        assert cache.stats == {'hits': 1, 'disk_hits': 1, 'misses': 0}
+
+
+def test_context_cache_key_interpreter(monkeypatch):
+    cache = ContextCache()
+    key = cache.key(case_class, '')
+    blob = cache.blob_key('abc123', '')
+
+    # tables parsed by other interpreters are not reused
+    monkeypatch.setattr(ContextCache, 'PYTHON', 'PyPy-2.7')
+    assert cache.key(case_class, '') != key
+    assert cache.blob_key('abc123', '') != blob
+
+
+def test_context_table():
+    pf = PythonFile('test.py', prefix='', source=case_class)
+    assert pf.lines == ctx_class
+    assert pf.line_count == len(ctx_class)
+    assert [pf.context(line) for line in range(0, 10)] == (
+        [''] + ctx_class + [''] * (9 - len(ctx_class)))
+
+    assert pf.contexts_between(1, 3) == {'', 'A'}
+    assert pf.contexts_between(4, 5) == {'A.method'}
+    assert pf.has_context('A.method')
+    assert not pf.has_context('A.missing')
+
+
+def test_context_ids():
+    pf = PythonFile('test.py', prefix='', source=case_class)
+    names = [pf.contexts[idx] for idx in pf.context_ids([2, 4, 5, 40])]
+    assert sorted(names) == ['', 'A', 'A.method']
+    assert pf.context_ids([4, 5]) == [pf.contexts.index('A.method')]
+    assert pf.context_ids([]) == []
@@ -0,0 +1,138 @@
+import random
+
+from smother.lineset import LineSet
+from smother.selection import budget
+from smother.selection import minimize
+from smother.selection import shard
+from smother.selection import weights
+
+
+def test_weights():
+    assert weights(['a', 'b', 'c'], {'a': 1.0, 'b': 3.0, 'x': 9.0}) == {
+        'a': 1.0, 'b': 3.0, 'c': 2.0}
+    assert weights(['a', 'b'], {}) == {'a': 1.0, 'b': 1.0}
+
+
+def test_shard():
+    durations = {'a': 5.0, 'b': 4.0, 'c': 3.0, 'd': 3.0, 'e': 2.0, 'f': 1.0}
+    groups = shard(sorted(durations, reverse=True), durations, 2)
+    assert groups == [['a', 'd', 'f'], ['b', 'c', 'e']]
+    assert [sum(durations[test] for test in group)
+            for group in groups] == [9.0, 9.0]
+
+
+def test_shard_without_durations():
+    tests = ['test%i' % i for i in range(10)]
+    groups = shard(tests, {}, 3)
+    assert sorted(map(len, groups)) == [3, 3, 4]
+    assert sorted(sum(groups, [])) == tests
+    assert shard(tests, {}, 1) == [tests]
+    assert shard([], {}, 2) == [[], []]
+
+
+def naive_budget(covers, durations, seconds):
+    """
+    Greedy selection, rescoring every test after each choice.
+    """
+    chosen, covered, spent = [], set(), 0.0
+    candidates = set(covers)
+    while True:
+        scores = [
+            (len(covers[test] - covered) / durations[test], test)
+            for test in candidates
+            if covers[test] - covered and
+            spent + durations[test] <= seconds
+        ]
+        if not scores:
+            return sorted(chosen), covered
+        _, test = max(scores)
+        candidates.remove(test)
+        chosen.append(test)
+        covered |= covers[test]
+        spent += durations[test]
+
+
+def test_budget():
+    covers = {
+        'slow': {1, 2, 3, 4},
+        'fast': {1, 2},
+        'other': {3},
+        'useless': set(),
+    }
+    durations = {'slow': 10.0, 'fast': 1.0, 'other': 1.0, 'useless': 0.1}
+
+    assert budget(covers, durations, 2.5) == (
+        ['fast', 'other'], {1, 2, 3}, 2.0)
+    assert budget(covers, durations, 0.5) == ([], set(), 0.0)
+    assert budget(covers, durations, 100)[1] == {1, 2, 3, 4}
+
+
+def test_budget_single_best():
+    # greedy prefers the cheap test, but the expensive one covers more
+    covers = {'cheap': {1}, 'big': {1, 2, 3, 4, 5}}
+    durations = {'cheap': 0.1, 'big': 10.0}
+    assert budget(covers, durations, 10.0) == (
+        ['big'], {1, 2, 3, 4, 5}, 10.0)
+
+
+def test_budget_matches_naive_greedy():
+    rng = random.Random(0)
+    for _ in range(20):
+        covers = {
+            'test%i' % idx: set(rng.sample(range(50), rng.randint(0, 10)))
+            for idx in range(100)
+        }
+        durations = {test: rng.uniform(0.1, 5.0) for test in covers}
+        chosen, covered, _ = budget(covers, durations, 20.0)
+        expected = naive_budget(covers, durations, 20.0)
+        if (chosen, covered) != expected:
+            # the best single test beat the greedy choice
+            assert len(chosen) == 1 and len(covered) > len(expected[1])
+
+
+def _lines(cover):
+    return {path: LineSet(lines) for path, lines in cover.items()}
+
+
+def test_minimize():
+    covers = {
+        'a': _lines({'x.py': [1, 2, 3], 'y.py': [1]}),
+        'b': _lines({'x.py': [3, 4]}),
+        'c': _lines({'x.py': [4, 5, 6, 7]}),
+        'd': _lines({'y.py': [1]}),
+        'e': {},
+    }
+    chosen, covered = minimize(covers)
+    assert chosen == ['a', 'c']
+    assert covered == {'x.py': list(range(1, 8)), 'y.py': [1]}
+
+    # ties go to the faster test
+    durations = {'a': 1.0, 'd': 1.0, 'f': 0.5}
+    covers['f'] = _lines({'y.py': [1]})
+    assert minimize({k: covers[k] for k in 'adf'}, durations)[0] == ['a']
+    assert minimize({k: covers[k] for k in 'df'}, durations)[0] == ['f']
+
+
+def test_minimize_preserves_coverage():
+    rng = random.Random(0)
+    covers = {
+        'test%i' % idx: _lines({
+            'f%i.py' % rng.randint(0, 5): rng.sample(range(1, 200), 20)
+            for _ in range(3)
+        })
+        for idx in range(200)
+    }
+    chosen, covered = minimize(covers)
+
+    total = {}
+    for cover in covers.values():
+        for path, lines in cover.items():
+            total[path] = lines | total.get(path, ())
+    assert covered == total
+    assert len(chosen) < len(covers)
+
+    union = {}
+    for test in chosen:
+        for path, lines in covers[test].items():
+            union[path] = lines | union.get(path, ())
+    assert union == total
@@ -0,0 +1,284 @@
+import json
+import os
+from io import BytesIO
+
+import pytest
+
+from smother import storage
+from smother.control import Smother
+from smother.interval import parse_intervals
+from smother.lineset import LineSet
+from smother.tests.utils import tempdir
+
+DATA = {
+    '': {'a.py': [1, 2, 3]},
+    'test1': {'a.py': [1], 'b.py': list(range(2, 400))},
+    'test2': {'b.py': [5, 300, 70000]},
+    'test3': {},
+}
+
+SET_CASES = [
+    [],
+    [0],
+    [1, 2, 3],
+    [5, 300, 70000],
+    list(range(1000)),
+    # a bitmap beats deltas only because the first delta is wide
+    list(range(300, 340)),
+    [7, 1 << 33],
+]
+
+
+@pytest.mark.parametrize('values', SET_CASES)
+def test_set_roundtrip(values):
+    encoded = storage.encode_set(values)
+    assert storage.decode_set(encoded) == (values, len(encoded))
+
+
+def test_set_encoding_choice():
+    dense = storage.encode_set(list(range(1000)))
+    sparse = storage.encode_set([1, 1000])
+    assert dense[0:1] == b'\x03'
+    assert sparse[0:1] == b'\x01'
+
+
+def test_binary_roundtrip():
+    contents = storage.dumps(DATA)
+    assert storage.is_binary(contents)
+    assert storage.loads(contents) == DATA
+
+
+def test_binary_deterministic():
+    assert storage.dumps(DATA) == storage.dumps(dict(DATA))
+
+
+def test_concatenated_segments():
+    a = {'test1': {'a.py': [1]}}
+    b = {'test1': {'a.py': [2]}, 'test2': {'a.py': [3]}}
+    contents = storage.dumps(a) + storage.dumps(b)
+    assert storage.loads(contents) == {
+        'test1': {'a.py': [1, 2]},
+        'test2': {'a.py': [3]},
+    }
+
+
+def test_json_autodetect():
+    assert storage.loads(json.dumps(DATA).encode('utf8')) == DATA
+    assert storage.loads(json.dumps(DATA)) == DATA
+
+
+@pytest.mark.parametrize('contents', [b'', b'garbage', b'\x93SMOTHER'])
+def test_invalid_report(contents):
+    with pytest.raises(ValueError):
+        storage.loads(contents)
+
+
+def test_write_format():
+    smother = Smother()
+    smother.data = DATA
+
+    with tempdir() as base:
+        binary = os.path.join(base, '.smother')
+        text = os.path.join(base, 'smother.json')
+        smother.write(binary)
+        smother.write(text)
+
+        with open(binary, 'rb') as infile:
+            assert storage.is_binary(infile.read())
+        with open(text) as infile:
+            assert json.load(infile) == DATA
+
+        assert Smother.load(binary).data == DATA
+        assert Smother.load(text).data == DATA
+
+
+def _report_dict(report):
+    return {test: dict(cover) for test, cover in report.items()}
+
+
+def test_report_lazy_view():
+    with tempdir() as base:
+        path = os.path.join(base, '.smother')
+        with open(path, 'wb') as outfile:
+            outfile.write(storage.dumps(DATA))
+
+        report = storage.Report.open(path)
+        try:
+            assert len(report) == len(DATA)
+            assert 'test1' in report
+            assert 'missing' not in report
+            assert report['test1']['b.py'] == DATA['test1']['b.py']
+            assert 'c.py' not in report['test1']
+            assert _report_dict(report) == DATA
+        finally:
+            report.close()
+
+
+def test_report_multiple_segments():
+    a = {'test1': {'a.py': [1]}}
+    b = {'test1': {'a.py': [2], 'b.py': [1]}, 'test2': {'a.py': [3]}}
+    report = storage.Report(storage.dumps(a) + storage.dumps(b))
+
+    assert sorted(report) == ['test1', 'test2']
+    assert _report_dict(report) == {
+        'test1': {'a.py': [1, 2], 'b.py': [1]},
+        'test2': {'a.py': [3]},
+    }
+
+    cover = report['test1']
+    assert list(cover.items()) == [(path, cover[path]) for path in cover]
+    assert list(cover.values()) == [cover[path] for path in cover]
+    assert cover['b.py'] == [1]
+
+
+def test_report_rejects_json():
+    with tempdir() as base:
+        path = os.path.join(base, '.smother')
+        with open(path, 'w') as outfile:
+            json.dump(DATA, outfile)
+
+        with pytest.raises(ValueError):
+            storage.Report.open(path)
+
+        assert Smother.load(path, lazy=True).data == DATA
+
+
+def test_report_index():
+    assert not storage.Report(storage.dumps(DATA)).indexed
+
+    report = storage.Report(storage.dumps(DATA, index=True))
+    assert report.indexed
+    assert report.tests_for_lines('a.py', lambda line: line == 1) == {
+        '', 'test1'}
+    assert report.tests_for_lines('b.py', lambda line: line > 400) == {
+        'test2'}
+    assert report.tests_for_lines('c.py', lambda line: True) == set()
+
+
+LOOKUPS = [
+    'smother.tests.demo',
+    'smother.tests.demo:8',
+    'smother.tests.demo:2-4',
+    'smother.tests.demo:bar',
+]
+
+
+@pytest.mark.parametrize('path', LOOKUPS)
+@pytest.mark.parametrize('semantic', [False, True])
+@pytest.mark.parametrize('index', [False, True])
+def test_lazy_queries_match(path, semantic, index):
+    eager = Smother.load('smother/tests/.smother')
+
+    with tempdir() as base:
+        report = os.path.join(base, '.smother')
+        eager.write(report, index=index)
+        lazy = Smother.load(report, lazy=True)
+
+        assert isinstance(lazy.data, storage.Report)
+        assert lazy._indexed() == index
+        regions = parse_intervals(path, as_context=semantic)
+        assert (lazy.query_context(regions).contexts ==
+                eager.query_context(regions).contexts)
+        assert (list(lazy.iter_records(semantic=semantic)) ==
+                list(eager.iter_records(semantic=semantic)))
+
+
+def test_merge_streams_segments():
+    a = storage.Report(
+        storage.dumps({'test2': {'a.py': [1]}}) +
+        storage.dumps({'test1': {'b.py': [2]}}))
+    b = {'test1': {'a.py': [3]}, 'test3': {'A.PY': [4]}}
+
+    out = BytesIO()
+    storage.merge([a, b], out, map_path=lambda path: path.lower())
+    assert storage.Report(out.getvalue()).indexed
+    assert storage.loads(out.getvalue()) == {
+        'test1': {'a.py': [3], 'b.py': [2]},
+        'test2': {'a.py': [1]},
+        'test3': {'a.py': [4]},
+    }
+
+
+# excludes the last case, whose bitmap would not fit in memory
+@pytest.mark.parametrize('values', SET_CASES[:-1])
+def test_encode_lineset(values):
+    assert (storage.encode_lineset(LineSet(values)) ==
+            storage.encode_set(values))
+
+
+def test_skip_incomplete_segment():
+    a = storage.dumps({'test1': {'a.py': [1]}})
+    b = storage.dumps({'test2': {'a.py': [2]}})
+    c = storage.dumps({'test3': {'a.py': [3]}})
+
+    # a writer was killed while appending b, then c was appended
+    for contents in [a + b[:-5], a + b[:30] + c, a + b[:-5] + c]:
+        data = storage.loads(contents)
+        assert data['test1'] == {'a.py': [1]}
+        assert 'test2' not in data
+
+    assert storage.loads(a + b[:30] + c)['test3'] == {'a.py': [3]}
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_report_tests_for_file(index):
+    report = storage.Report(
+        storage.dumps(DATA, index=index) +
+        storage.dumps({'test4': {'a.py': [9]}}, index=index))
+    assert report.tests_for_file('a.py') == {'', 'test1', 'test4'}
+    assert report.tests_for_file('b.py') == {'test1', 'test2'}
+    assert report.tests_for_file('c.py') == set()
+
+
+def test_durations():
+    durations = {'test1': 0.5, 'test2': 2.0}
+    contents = storage.dumps(DATA, durations=durations)
+    assert storage.loads(contents) == DATA
+    assert storage.loads_durations(contents) == durations
+    assert storage.Report(contents).durations() == durations
+
+    # a test recorded in several segments keeps its longest duration
+    later = storage.dumps({'test1': {}}, durations={'test1': 3.0})
+    assert storage.loads_durations(contents + later) == {
+        'test1': 3.0, 'test2': 2.0}
+    assert storage.Report(contents + later).durations() == {
+        'test1': 3.0, 'test2': 2.0}
+
+    # JSON reports and segments without durations have none
+    assert storage.loads_durations(storage.dumps(DATA, storage.JSON)) == {}
+    assert storage.loads_durations(storage.dumps(DATA)) == {}
+
+
+def test_compact_indexes():
+    with tempdir() as base:
+        path = os.path.join(base, '.smother')
+        with open(path, 'wb') as outfile:
+            outfile.write(storage.dumps(DATA))
+
+        with open(path, 'r+b') as fh:
+            assert storage.compact(fh)
+            assert not storage.compact(fh)
+
+        report = storage.Report.open(path)
+        try:
+            assert report.indexed
+            assert _report_dict(report) == DATA
+        finally:
+            report.close()
+
+
+def test_compact_keeps_durations():
+    with tempdir() as base:
+        path = os.path.join(base, '.smother')
+        with open(path, 'wb') as outfile:
+            outfile.write(storage.dumps(DATA, durations={'test1': 1.0}))
+            outfile.write(storage.dumps({'test4': {}},
+                                        durations={'test4': 4.0}))
+
+        with open(path, 'r+b') as fh:
+            assert storage.compact(fh)
+        with open(path, 'rb') as infile:
+            contents = infile.read()
+        assert len(list(storage.iter_segments(contents))) == 1
+        assert storage.loads_durations(contents) == {
+            'test1': 1.0, 'test4': 4.0}